@@ -7,23 +7,52 @@ header information, except maybe for flats. If a file has "flat" in the
 filename (not case-sensitive), it will be used as a flat in the appropriate
 filter.
 
+Frames are calibrated and combined in float32 by default, which halves the
+memory and bandwidth needed compared to float64. Raw 16-bit data is exactly
+representable in float32, and each calibration step then rounds to within
+a relative 2**-24 (about 6e-8), so calibrated pixels differ from a float64
+reduction by at most about 1e-6 of the raw pixel level (0.07 ADU at full
+scale), far below the read noise. Pass float64 as the working dtype to reproduce
+the old results exactly.
+
 For help on command line arguments:
 > python MaximDL_dataproc.py -h
 """
 
 # Standard library imports
 import os
+import time
+import logging
 from collections import defaultdict
 import argparse
 from datetime import datetime
 import warnings
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
 
 # Non-standard imports
 import numpy as np
 from astropy.io import fits
 from astropy.utils.exceptions import AstropyWarning
+
+logger = logging.getLogger(__name__)
 warnings.simplefilter('ignore', category=AstropyWarning)
 
+# Header keywords kept in the index of input files
+INDEX_KEYWORDS = ('IMAGETYP', 'FILTER', 'EXPTIME')
+FITS_BLOCK = 2880
+
+# Stack combining works on chunks of rows of about this many values
+COMBINE_CHUNK = 2**22
+REJECTION_DTYPE = np.int32
+
+# Master frames attached by each worker process in --workers mode
+shared_frames = dict()
+shared_blocks = []
+
 
 def genfiles(path, file_extension='.fits'):
     for entry in os.scandir(path):
@@ -31,21 +60,281 @@ def genfiles(path, file_extension='.fits'):
             yield entry.path
 
 
-def median_combine(filenames, bias=None, dark=None, flat=None, normalize=False, hdu_num=0):
-    """median-combine a collection of fits images.
+def read_header(filename, keywords=INDEX_KEYWORDS):
+    """read keywords and the image shape from a fits file's primary header.
+
+    Only the 2880-byte header blocks are read, stopping at the END card, so
+    the cost does not depend on the size of the data. Keywords that are not
+    in the header are left out of the returned dict, and the shape is in
+    numpy (axis 0 first) order.
+    """
+    cards = dict()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise IOError('{} ended before its END card'.format(filename))
+            for start in range(0, FITS_BLOCK, 80):
+                card = block[start:start+80].decode('ascii', 'replace')
+                keyword = card[:8].rstrip()
+                if keyword == 'END':
+                    naxis = cards.get('NAXIS', 0)
+                    header = {key: cards[key] for key in keywords if key in cards}
+                    header['shape'] = [cards['NAXIS{}'.format(n)] for n in range(naxis, 0, -1)]
+                    return header
+                if card[8:10] == '= ' and (keyword in keywords or keyword.startswith('NAXIS')):
+                    cards[keyword] = fits.Card.fromstring(card).value
+
+
+def index_headers(filenames, index_path=None, on_error=None):
+    """read_header for each file, reusing entries from an on-disk index.
+
+    Each entry also records the file's size and mtime, and files whose size
+    and mtime match the index are not opened at all. If index_path is given,
+    the index is loaded from it if it exists and rewritten with the entries
+    of exactly these files.
+
+    Keyword arguments:
+    on_error -- a function called with the filename and the OSError for each
+    file that cannot be read, which is then left out. By default the error
+    is raised.
+
+    Returns a dict of filename: entry in the order of filenames.
+    """
+    index = dict()
+    if index_path is not None and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    entries = dict()
+    for filename in filenames:
+        key = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+            entry = index.get(key)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                entry = read_header(filename)
+                entry['size'] = stat.st_size
+                entry['mtime'] = stat.st_mtime_ns
+        except OSError as error:
+            if on_error is None:
+                raise
+            on_error(filename, error)
+            continue
+        entries[filename] = entry
+
+    if index_path is not None:
+        index = {os.path.abspath(filename): entry for filename, entry in entries.items()}
+        # write-then-rename so that an interrupted run never leaves a truncated index
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    return entries
+
+
+def master_key(filenames, **params):
+    """hash the files that make up a master frame and how they are combined.
+
+    The key covers each file's absolute path, size and mtime plus params,
+    which must be JSON-serializable, so it changes whenever an input file or
+    the combine parameters do.
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(os.path.abspath(filename) for filename in filenames):
+        stat = os.stat(filename)
+        digest.update('{}\0{}\0{}\n'.format(filename, stat.st_size, stat.st_mtime_ns).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def cached_master(cache_directory, key, cache_size, combine, dtype=np.float32):
+    """return the master frame stored under key, or make and store it.
+
+    Masters are kept as FITS files in cache_directory. The cache is LRU: a hit
+    touches the file's mtime, and after a store the least recently used files
+    are deleted until the cache holds at most cache_size bytes.
+
+    Arguments:
+    combine -- a function of no arguments that produces the master frame
+    dtype -- the dtype a cached master is returned as
+    """
+    path = os.path.join(cache_directory, key + '.fits')
+    if os.path.isfile(path):
+        os.utime(path)
+        return fits.getdata(path).astype(dtype)
+
+    master = combine()
+
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    # write-then-rename so that a concurrent or interrupted run never sees a partial master
+    fits.writeto(path + '.tmp', master, overwrite=True)
+    os.replace(path + '.tmp', path)
+
+    entries = [entry for entry in os.scandir(cache_directory) if entry.is_file() and entry.name.endswith('.fits')]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= cache_size:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+    return master
+
+
+def calibrate(image, header, bias=None, dark=None, flat=None, normalize=False, scratch=None):
+    """apply calibration frames to an image in place and return it.
+
+    Keyword arguments:
+    bias -- a numpy ndarray to be subtracted from the image
+    dark -- a numpy ndarray multiplied by the header's EXPTIME and subtracted.
+    flat -- a numpy ndarray to divide the image by
+    normalize -- divide the image by its exposure time
+    scratch -- an array the shape of the image to hold the scaled dark, so
+    that calibrating many images does not allocate a temporary for each
+    """
+    if bias is not None:
+        image -= bias
+    if dark is not None:
+        image -= np.multiply(dark, header['EXPTIME'], out=scratch)
+    if flat is not None:
+        image /= flat
+    if normalize:
+        image /= header['EXPTIME']
+
+    return image
+
+
+def median_stack(stack):
+    """per-pixel median along axis 0. Nothing is rejected."""
+    return np.median(stack, axis=0, overwrite_input=True), np.zeros(stack.shape[1:], REJECTION_DTYPE)
+
+
+def mean_stack(stack):
+    """per-pixel mean along axis 0. Nothing is rejected."""
+    return np.mean(stack, axis=0), np.zeros(stack.shape[1:], REJECTION_DTYPE)
+
+
+def sigma_clip_stack(stack, sigma_low=3., sigma_high=3., iterations=5):
+    """per-pixel mean along axis 0 after iterative sigma clipping.
+
+    Values more than sigma_low standard deviations below or sigma_high above
+    the mean of the values still kept are rejected, until nothing changes or
+    after the given number of iterations. The value nearest the mean is
+    never more than one standard deviation from it, so with sigma_low and
+    sigma_high at least 1 every pixel keeps at least one value.
+    """
+    if sigma_low < 1 or sigma_high < 1:
+        raise ValueError('sigma_low and sigma_high must be at least 1, not {} and {}'.format(sigma_low, sigma_high))
+    keep = np.ones(stack.shape, bool)
+    count = np.full(stack.shape[1:], stack.shape[0])
+    mean = np.mean(stack, axis=0)
+    for _ in range(iterations):
+        deviation = stack - mean
+        deviation[~keep] = 0
+        std = np.sqrt(np.sum(deviation**2, axis=0) / count)
+
+        new_keep = (stack >= mean - sigma_low*std) & (stack <= mean + sigma_high*std)
+        new_keep &= keep
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+        count = np.sum(keep, axis=0)
+        mean = np.sum(stack, axis=0, where=keep) / count
+
+    return mean, (stack.shape[0] - count).astype(REJECTION_DTYPE)
+
+
+def minmax_stack(stack, nlow=1, nhigh=1):
+    """per-pixel mean along axis 0 after rejecting the nlow lowest and nhigh
+    highest values."""
+    nframes = stack.shape[0]
+    if nlow + nhigh >= nframes:
+        raise ValueError('cannot reject {} of {} values'.format(nlow + nhigh, nframes))
+    stack.partition(list(range(nlow)) + list(range(nframes - nhigh, nframes)), axis=0)
+    return np.mean(stack[nlow:nframes-nhigh], axis=0), np.full(stack.shape[1:], nlow + nhigh, REJECTION_DTYPE)
+
+
+def winsorize_stack(stack, limit=0.1):
+    """per-pixel winsorized mean along axis 0.
+
+    In each pixel the lowest and highest limit fraction of the values are
+    replaced with the nearest value that is kept before taking the mean.
+    The rejection map counts the values that were replaced with a different
+    value.
+    """
+    nframes = stack.shape[0]
+    trim = int(limit * nframes)
+    if 2*trim >= nframes:
+        raise ValueError('cannot winsorize {} of {} values'.format(2*trim, nframes))
+    bounds = np.partition(stack, [trim, nframes - trim - 1], axis=0)
+    low, high = bounds[trim], bounds[nframes - trim - 1]
+    rejected = np.sum((stack < low) | (stack > high), axis=0, dtype=REJECTION_DTYPE)
+    np.clip(stack, low, high, out=stack)
+    return np.mean(stack, axis=0), rejected
+
+
+COMBINE_METHODS = {
+    'median': median_stack,
+    'mean': mean_stack,
+    'sigma_clip': sigma_clip_stack,
+    'minmax': minmax_stack,
+    'winsorize': winsorize_stack,
+}
+
+
+def combine_stack(stack, method='median', **options):
+    """combine a stack of images along axis 0 with one of COMBINE_METHODS.
+
+    The methods are vectorized over the stack axis and applied to chunks of
+    rows so that their temporary arrays stay small. The stack may be
+    overwritten. The combined image is float32 for stacks of float32 or
+    16-bit integers and float64 otherwise.
+
+    Returns the combined image and a map of how many values were rejected
+    in each pixel.
+    """
+    combine = COMBINE_METHODS[method]
+    nframes, nrows = stack.shape[:2]
+    chunk_rows = max(1, COMBINE_CHUNK // max(1, stack[:, 0].size))
+
+    combined = np.empty(stack.shape[1:], np.result_type(stack.dtype, np.float32))
+    rejected = np.empty(stack.shape[1:], REJECTION_DTYPE)
+    for start in range(0, nrows, chunk_rows):
+        rows = slice(start, start+chunk_rows)
+        combined[rows], rejected[rows] = combine(stack[:, rows], **options)
+
+    return combined, rejected
+
+
+def median_combine(filenames, bias=None, dark=None, flat=None, normalize=False, hdu_num=0, memory_limit=None,
+                   method='median', rejection_map=False, dtype=np.float32, **options):
+    """median-combine a collection of fits images, or combine them with
+    another of the COMBINE_METHODS.
     
     Keyword arguments:
     bias -- a numpy ndarray to be subtracted from the final result
     dark -- a numpy ndarray multiplied by each image's EXPTIME and subtracted.
     flat -- a numpy ndarray to divide each image by before combining
     normalize -- divide each image by its exposure time
+    memory_limit -- if given, the most bytes the image stack may use. The
+    images are then combined in bands of rows by tiled_median_combine.
+    method -- the name of a combine method in COMBINE_METHODS to use in
+    place of the median. Any other keyword arguments are passed to it.
+    rejection_map -- also return the number of values rejected in each pixel
+    dtype -- the floating point dtype images are calibrated and combined in
     """
+    if memory_limit is not None:
+        return tiled_median_combine(filenames, memory_limit, bias, dark, flat, normalize, hdu_num,
+                                    method, rejection_map, dtype, **options)
 
     imshape = fits.open(filenames[0])[hdu_num].data.shape
     try:
-        stack = np.empty((len(filenames),)+imshape)
+        stack = np.empty((len(filenames),)+imshape, dtype)
     except MemoryError:
-        print('Too many files to combine')
+        print('Too many files to combine, try setting a memory limit')
         if bias is None:
             print('file type: bias')
         elif dark is None:
@@ -54,39 +343,101 @@ def median_combine(filenames, bias=None, dark=None, flat=None, normalize=False,
             print('file type: flat')
         exit()
 
+    scratch = None if dark is None else np.empty(imshape, dtype)
     for f, fname in enumerate(filenames):
         hdu = fits.open(fname)[hdu_num]
-        image = hdu.data.astype(float)
-        if bias:
-            image -= bias
-        if dark:
-            image -= hdu.header['EXPTIME']*dark
-        if flat:
-            image /= flat
-        if normalize:
-            image /= hdu.header['EXPTIME']
-        
-        stack[f] = image
+        stack[f] = hdu.data
+        calibrate(stack[f], hdu.header, bias, dark, flat, normalize, scratch)
     
-    return np.median(stack, axis=0, overwrite_input=True)
+    combined, rejected = combine_stack(stack, method, **options)
+    if rejection_map:
+        return combined, rejected
+    return combined
 
 
-def maximdl_dataproc(input_directory, output_directory=None, hdu_num=0):
+def tiled_median_combine(filenames, memory_limit, bias=None, dark=None, flat=None, normalize=False, hdu_num=0,
+                         method='median', rejection_map=False, dtype=np.float32, **options):
+    """median-combine a collection of fits images without loading them whole.
 
+    Every file is memory-mapped and the stack is built and combined one band
+    of rows at a time, so peak memory is bounded by memory_limit regardless of
+    how many files there are. The result is identical to median_combine.
+
+    Arguments:
+    memory_limit -- the most bytes the stack of one band may use. At least
+    one row from every image is always loaded.
+
+    See median_combine for the keyword arguments.
+    """
+    # astropy memory-maps by default, and unlike memmap=True it will still scale
+    # sections of integer images that have BZERO or BSCALE set
+    hdulists = [fits.open(fname) for fname in filenames]
+    try:
+        hdus = [hdulist[hdu_num] for hdulist in hdulists]
+        imshape = hdus[0].shape
+        row_bytes = len(hdus) * int(np.prod(imshape[1:])) * np.dtype(dtype).itemsize
+        band_rows = int(min(imshape[0], max(1, memory_limit // row_bytes)))
+
+        stack = np.empty((len(hdus), band_rows)+imshape[1:], dtype)
+        scratch = None if dark is None else np.empty((band_rows,)+imshape[1:], dtype)
+        combined = np.empty(imshape, dtype)
+        rejected = np.empty(imshape, REJECTION_DTYPE)
+
+        for start in range(0, imshape[0], band_rows):
+            rows = slice(start, min(start+band_rows, imshape[0]))
+            band = stack[:, :rows.stop-rows.start]
+            band_bias, band_dark, band_flat = (None if frame is None else frame[rows] for frame in (bias, dark, flat))
+
+            for f, hdu in enumerate(hdus):
+                band[f] = hdu.section[rows]
+                calibrate(band[f], hdu.header, band_bias, band_dark, band_flat, normalize,
+                          None if scratch is None else scratch[:len(band[f])])
+
+            combined[rows], rejected[rows] = combine_stack(band, method, **options)
+    finally:
+        for hdulist in hdulists:
+            hdulist.close()
+
+    if rejection_map:
+        return combined, rejected
+    return combined
+
+
+def flat_combine(filenames, bias, dark, hdu_num=0, memory_limit=None, method='median', dtype=np.float32):
+    """median-combine flats into a master flat normalized to a median of 1."""
+    flat = median_combine(filenames, bias=bias, dark=dark, normalize=True, hdu_num=hdu_num,
+                          memory_limit=memory_limit, method=method, dtype=dtype)
+    np.clip(flat, 1, None, out=flat)
+    flat /= np.median(flat)
+    return flat
+
+
+def output_locations(input_directory, output_directory=None, index_path=None, cache_directory=None):
+    """fill in the default output directory, header index and master cache
+    locations, and create the output directory if needed."""
     if output_directory is None:
         output_directory = os.path.join(os.path.dirname(input_directory), 'processed')
     if not os.path.isdir(output_directory):
         os.mkdir(output_directory)
+    if index_path is None:
+        index_path = os.path.join(output_directory, 'header_index.json')
+    if cache_directory is None:
+        cache_directory = os.path.join(output_directory, 'master_cache')
+    return output_directory, index_path, cache_directory
 
-    filenames = genfiles(input_directory)
+
+def classify_frames(headers):
+    """sort files into bias, dark, per-filter flat and per-filter Light frames.
+
+    Arguments:
+    headers -- a dict of filename: header as returned by index_headers
+    """
     dark_names = []
     bias_names = []
     flat_names = defaultdict(list)
     science_names = defaultdict(list)
 
-    for filename in filenames:
-        head = fits.open(filename)[0].header
-        
+    for filename, head in headers.items():
         imtype = head['IMAGETYP'].split()[0]
         
         if imtype == 'Bias':
@@ -100,35 +451,230 @@ def maximdl_dataproc(input_directory, output_directory=None, hdu_num=0):
             filt = head['FILTER']
             science_names[filt].append(filename)
 
-    bias = median_combine(bias_names, hdu_num=hdu_num)
+    return bias_names, dark_names, flat_names, science_names
+
+
+def make_masters(bias_names, dark_names, flat_names, cache_directory, cache_size=2**31, hdu_num=0, memory_limit=None,
+                 method='median', dtype=np.float32, loaded=None):
+    """combine the master bias, dark and flats, or fetch them from the cache.
+
+    Keyword arguments:
+    loaded -- a dict of cache key: master frame checked before the cache on
+    disk. It is updated to hold exactly the masters returned, so a long
+    running process only reads or combines a master when its inputs change.
+
+    Returns the bias, the dark and a dict of filter: flat.
+    """
+    if loaded is None:
+        loaded = dict()
+    used = set()
+    dtype = np.dtype(dtype)
+
+    def master(key, combine):
+        if key not in loaded:
+            loaded[key] = cached_master(cache_directory, key, cache_size, combine, dtype)
+        used.add(key)
+        return loaded[key]
 
-    dark = median_combine(dark_names, bias=bias, normalize=True, hdu_num=hdu_num)
+    # memory_limit is left out of the keys because it does not change the result
+    bias_key = master_key(bias_names, frame='bias', hdu_num=hdu_num, method=method, dtype=dtype.name)
+    bias = master(bias_key, partial(median_combine, bias_names, hdu_num=hdu_num, memory_limit=memory_limit,
+                                    method=method, dtype=dtype))
+
+    dark_key = master_key(dark_names, frame='dark', bias=bias_key, hdu_num=hdu_num, method=method, dtype=dtype.name)
+    dark = master(dark_key, partial(median_combine, dark_names, bias=bias, normalize=True, hdu_num=hdu_num,
+                                    memory_limit=memory_limit, method=method, dtype=dtype))
 
     flats = dict()
     for filt in flat_names:
-        flats[filt] = median_combine(flat_names[filt], bias=bias, dark=dark, normalize=True, hdu_num=hdu_num).clip(1)
-        flats[filt] /= np.median(flats[filt])
+        flat_key = master_key(flat_names[filt], frame='flat', filter=filt, bias=bias_key, dark=dark_key, hdu_num=hdu_num,
+                              method=method, dtype=dtype.name)
+        flats[filt] = master(flat_key, partial(flat_combine, flat_names[filt], bias, dark, hdu_num, memory_limit,
+                                               method, dtype))
+
+    for key in set(loaded) - used:
+        del loaded[key]
+
+    return bias, dark, flats
+
+
+def maximdl_dataproc(input_directory, output_directory=None, hdu_num=0, memory_limit=None, workers=1, index_path=None,
+                     cache_directory=None, cache_size=2**31, method='median', dtype=np.float32):
+
+    output_directory, index_path, cache_directory = output_locations(input_directory, output_directory, index_path,
+                                                                     cache_directory)
+
+    headers = index_headers(genfiles(input_directory), index_path)
+    bias_names, dark_names, flat_names, science_names = classify_frames(headers)
+
+    bias, dark, flats = make_masters(bias_names, dark_names, flat_names, cache_directory, cache_size, hdu_num,
+                                     memory_limit, method, dtype)
 
-    for filt in science_names:
-        for science_name in science_names[filt]:
-            input_hdu = fits.open(science_name)[0]
-            image = input_hdu.data.astype(float)
-            
-            image -= bias
-            image -= dark*input_hdu.header['EXPTIME']
-            image /= flats[filt]
+    processed = str(datetime.now())
 
-            output_path = os.path.join(output_directory, os.path.basename(science_name)).replace('.fits', '_proc.fits')
+    if workers > 1:
+        frames = {'bias': bias, 'dark': dark}
+        frames.update((('flat', filt), flat) for filt, flat in flats.items())
+        blocks, layout = share_frames(frames)
+        try:
+            with ProcessPoolExecutor(workers, initializer=attach_frames, initargs=(layout,)) as executor:
+                names = [(science_name, filt) for filt in science_names for science_name in science_names[filt]]
+                futures = [executor.submit(process_shared_science_frame, science_name, filt, output_directory, processed)
+                           for science_name, filt in names]
+                # collect in submission order, re-raising any worker error
+                for future in futures:
+                    future.result()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        scratch = np.empty_like(bias)
+        for filt in science_names:
+            for science_name in science_names[filt]:
+                process_science_frame(science_name, output_directory, bias, dark, flats[filt], processed, scratch)
 
-            head = input_hdu.header
-            head.append(('PROCESSD', str(datetime.now()), 'date+time processed'))
-            
-            output_hdu = fits.PrimaryHDU(data=image, header=head)
-            output_hdu.add_checksum()
-            
-            hdulist = fits.HDUList(hdus=[output_hdu])
 
-            hdulist.writeto(output_path, clobber=True)
+def watch(input_directory, output_directory=None, interval=2., hdu_num=0, memory_limit=None, index_path=None,
+          cache_directory=None, cache_size=2**31, method='median', dtype=np.float32):
+    """calibrate Light frames as they are written into input_directory.
+
+    The directory is polled every interval seconds until interrupted. A file
+    is only read once its size and mtime are the same on two polls in a row,
+    so frames that are still being written are left alone. Masters are kept
+    in memory and only recombined (or fetched from the cache) when their
+    calibration frames change.
+
+    Light frames without an output file are calibrated once their bias, dark
+    and flat are available, no file in the directory is still being written
+    and the masters are the same as on the previous poll. A Light frame is
+    not calibrated again when its masters change later, so copy the
+    calibration frames in before the Light frames, or delete the outputs to
+    have them redone. Files that cannot be read or calibrated are logged and
+    skipped until they change.
+
+    See maximdl_dataproc for the other arguments.
+    """
+    output_directory, index_path, cache_directory = output_locations(input_directory, output_directory, index_path,
+                                                                     cache_directory)
+
+    loaded = dict()
+    previous = dict()
+    failed = dict()
+
+    def skip(filename, error):
+        logger.warning('skipping %s: %s', filename, error)
+        failed[filename] = current.get(filename)
+
+    while True:
+        current = dict()
+        for filename in genfiles(input_directory):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                # deleted since it was listed
+                continue
+            current[filename] = (stat.st_size, stat.st_mtime_ns)
+        ready = [filename for filename in current
+                 if previous.get(filename) == current[filename] and failed.get(filename) != current[filename]]
+        settled = len(ready) + sum(failed.get(filename) == current[filename] for filename in current) == len(current)
+        previous = current
+
+        headers = index_headers(ready, index_path, on_error=skip)
+        bias_names, dark_names, flat_names, science_names = classify_frames(headers)
+
+        if bias_names and dark_names:
+            masters = set(loaded)
+            bias, dark, flats = make_masters(bias_names, dark_names, flat_names, cache_directory, cache_size, hdu_num,
+                                             memory_limit, method, dtype, loaded)
+            if settled and set(loaded) == masters:
+                processed = str(datetime.now())
+                scratch = np.empty_like(bias)
+                for filt in science_names:
+                    if filt not in flats:
+                        continue
+                    for science_name in science_names[filt]:
+                        if os.path.exists(science_output_path(science_name, output_directory)):
+                            continue
+                        try:
+                            output_path = process_science_frame(science_name, output_directory, bias, dark,
+                                                                flats[filt], processed, scratch)
+                        except (OSError, ValueError) as error:
+                            skip(science_name, error)
+                        else:
+                            logger.info('calibrated %s', output_path)
+
+        time.sleep(interval)
+
+
+def science_output_path(science_name, output_directory):
+    """where the calibrated copy of a science frame is written"""
+    return os.path.join(output_directory, os.path.basename(science_name)).replace('.fits', '_proc.fits')
+
+
+def process_science_frame(science_name, output_directory, bias, dark, flat, processed, scratch=None):
+    """calibrate one science frame and write it to output_directory.
+
+    Arguments:
+    processed -- the date+time string recorded in the PROCESSD card and the
+    checksum comments, shared by every frame in a run
+    scratch -- an array like the bias, reused by calibrate for every frame
+
+    The frame is calibrated and written in the dtype of the bias.
+    """
+    input_hdu = fits.open(science_name)[0]
+    image = calibrate(input_hdu.data.astype(bias.dtype), input_hdu.header, bias, dark, flat, scratch=scratch)
+
+    output_path = science_output_path(science_name, output_directory)
+
+    head = input_hdu.header
+    head.append(('PROCESSD', processed, 'date+time processed'))
+
+    output_hdu = fits.PrimaryHDU(data=image, header=head)
+    output_hdu.add_checksum(when=processed)
+
+    hdulist = fits.HDUList(hdus=[output_hdu])
+
+    # write-then-rename so that the output is never seen half written
+    hdulist.writeto(output_path + '.tmp', overwrite=True)
+    os.replace(output_path + '.tmp', output_path)
+    return output_path
+
+
+def share_frames(frames):
+    """copy a dict of ndarrays into shared memory.
+
+    Returns the SharedMemory blocks, which the caller must close and unlink
+    when done, and a picklable layout to hand to attach_frames.
+    """
+    blocks = []
+    layout = []
+    for key, frame in frames.items():
+        block = shared_memory.SharedMemory(create=True, size=max(1, frame.nbytes))
+        blocks.append(block)
+        np.ndarray(frame.shape, frame.dtype, buffer=block.buf)[...] = frame
+        layout.append((key, block.name, frame.shape, frame.dtype.str))
+    return blocks, layout
+
+
+def attach_frames(layout):
+    """process pool initializer that maps the frames from share_frames into
+    this process as read-only arrays in shared_frames."""
+    for key, name, shape, dtype in layout:
+        block = shared_memory.SharedMemory(name=name)
+        # keep the block referenced for as long as the array is in use
+        shared_blocks.append(block)
+        frame = np.ndarray(shape, dtype, buffer=block.buf)
+        frame.flags.writeable = False
+        shared_frames[key] = frame
+    # private to this process, reused for every frame it calibrates
+    shared_frames['scratch'] = np.empty_like(shared_frames['bias'])
+
+
+def process_shared_science_frame(science_name, filt, output_directory, processed):
+    """process_science_frame using the master frames in shared_frames."""
+    return process_science_frame(science_name, output_directory, shared_frames['bias'], shared_frames['dark'],
+                                 shared_frames['flat', filt], processed, shared_frames['scratch'])
 
 
 if __name__ == '__main__':
@@ -137,6 +683,32 @@ if __name__ == '__main__':
     parser.add_argument('-out', '--output_directory', default=None,
                         help='relative or absolute path to a directory to place all processed data. Will be created if needed. If none is given, an output directory is created next to the input directory.')
     parser.add_argument('-hdu', '--image_hdu', type=int, default=0, help='0-based index of the image HDU to process')
+    parser.add_argument('-mem', '--memory_limit', type=float, default=None,
+                        help='maximum size in MB of each stack of calibration frames. If given, frames are memory-mapped and combined in bands of rows.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to calibrate science frames')
+    parser.add_argument('-cache', '--cache_directory', default=None,
+                        help='directory to keep master calibration frames in between runs. If none is given, a master_cache directory is created in the output directory.')
+    parser.add_argument('--cache_size', type=float, default=2048,
+                        help='maximum total size in MB of the master frame cache')
+    parser.add_argument('-m', '--method', default='median', choices=sorted(COMBINE_METHODS),
+                        help='how to combine calibration frames into masters; every method but median uses default rejection parameters')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'],
+                        help='floating point precision to calibrate in and write output with')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and calibrate Light frames as they are written into the input directory')
+    parser.add_argument('--interval', type=float, default=2., help='seconds between checks for new files in --watch mode')
     args = parser.parse_args()
 
-    maximdl_dataproc(args.input_directory, args.output_directory, args.image_hdu)
+    memory_limit = None if args.memory_limit is None else int(args.memory_limit * 2**20)
+
+    cache_size = int(args.cache_size * 2**20)
+
+    if args.watch:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+        watch(args.input_directory, args.output_directory, args.interval, args.image_hdu, memory_limit,
+              cache_directory=args.cache_directory, cache_size=cache_size, method=args.method, dtype=args.dtype)
+    else:
+        maximdl_dataproc(args.input_directory, args.output_directory, args.image_hdu, memory_limit, args.workers,
+                         cache_directory=args.cache_directory, cache_size=cache_size, method=args.method,
+                         dtype=args.dtype)
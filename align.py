@@ -4,38 +4,109 @@ This module (or script) provides tools for aligning images. The general
 technique is to pick an image in a set (the template) and shift every
 other image to match up features.
 
+median_downsample -- Downsample an image by taking the median of each block
+mean_downsample -- Downsample an image by taking the mean of each block
 shift_int -- Quickly shifts two images and compute a similarity parameter,
 lower is better
+shift_scores -- Evaluate shift_int at many offsets in parallel
 align_int -- Brute-force integer alignment of two images within bounds
 make_pretty -- Apply median-based sky removal and white threshold
 align -- Align an image to a template
+template_spectrum -- Precompute the Fourier transform of a template
+phase_correlate -- Subpixel offsets between an image and a template spectrum
+align_fft -- Align an image to a template by phase correlation
+Aligner -- Align many images to one template, preparing the template once
+read_images -- Read a sequence of arrays or fits file paths one image at a time
+triangle_invariants -- Scale- and rotation-invariant descriptors of star triangles
+fit_similarity -- Least-squares rotation, scale and translation between point sets
+match_stars -- Solve for the transform between two star lists by matching triangles
+StarAligner -- Register images with rotation and scale by matching stars
+align_sequence -- Align a sequence of fits files in parallel
 """
 
 import os
-import operator
+import itertools
 from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import numba
+import scipy.ndimage
+import scipy.spatial
 from scipy.ndimage.interpolation import shift
 
+from detection import find_stars
 
-def median_downsample(image, factor):
+
+def block_view(image, factor):
+    """
+    View an image as a (height/factor, factor, width/factor, factor) array
+    of factor x factor blocks without copying it. Rows and columns that do
+    not fill a whole block are left out.
+    """
+    h, w = image.shape[0]//factor, image.shape[1]//factor
+    return image[:h*factor, :w*factor].reshape(h, factor, w, factor)
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def block_median(image, factor):
+    """
+    The median of each factor x factor block of an image, gathering one
+    block at a time into a small buffer instead of copying the whole image.
+    Small blocks are insertion sorted, which beats a general sort. The
+    output has the dtype of the image, and the median of an even block is
+    the mean of its middle pair in that dtype, like numpy's.
+    """
+    h, w = image.shape[0]//factor, image.shape[1]//factor
+    n = factor*factor
+    output = np.empty((h, w), image.dtype)
+    block = np.empty(n, image.dtype)
+    for row in range(h):
+        for col in range(w):
+            for k in range(n):
+                value = image[row*factor + k//factor, col*factor + k % factor]
+                i = k
+                while n <= 25 and i > 0 and block[i-1] > value:
+                    block[i] = block[i-1]
+                    i -= 1
+                block[i] = value
+            if n > 25:
+                block.sort()
+            if n % 2:
+                output[row, col] = block[n//2]
+            else:
+                output[row, col] = (block[n//2 - 1] + block[n//2]) / 2
+    return output
+
+
+def median_downsample(image, factor, jit=True):
     """
     Simultaneously downsample and median filter an image.
     Each pixel at [y,x] in the returned image is the median of
     the region [y*factor:(y+1)*factor, x*factor:(x+1)*factor].
 
     This can result in some significant loss of data but will preserve
-    most of the large features in an image. CHANGE HERE
-    """
-    stack = np.empty((factor, image.shape[0]//factor, image.shape[1]//factor))
+    most of the large features in an image.
 
-    subimage = image[:image.shape[0]//factor * factor, :image.shape[1]//factor * factor]
+    Arguments:
+    jit -- Use the numba kernel block_median, which needs no temporary the
+    size of the image. Otherwise the median is taken over a block_view with
+    numpy. Both give the same result. float32 and float64 images are used
+    as they are, and other images are converted to float64 first.
+    """
+    image = np.asarray(image)
+    if image.dtype != np.float32:
+        image = image.astype(np.float64, copy=False)
+    if jit:
+        return block_median(image, factor)
+    return np.median(block_view(image, factor), axis=(1, 3))
 
-    for i in range(factor):
-        stack[i] = subimage[i::factor, i::factor]
 
-    return np.median(stack, axis=0)
+def mean_downsample(image, factor):
+    """
+    Simultaneously downsample and box filter an image.
+    Each pixel at [y,x] in the returned image is the mean of
+    the region [y*factor:(y+1)*factor, x*factor:(x+1)*factor].
+    """
+    return block_view(image, factor).mean(axis=(1, 3))
 
 
 @numba.jit(nopython=True, cache=True, nogil=True)
@@ -66,7 +137,32 @@ def shift_int(template, image, y, x):
     return output/shifted_image.size
 
 
-def align_int(template, image, span=None, y_init=0, x_init=0):
+@numba.jit(nopython=True, cache=True, nogil=True, parallel=True)
+def shift_scores(template, image, offsets):
+    """
+    Evaluate shift_int at every row of an (n, 2) array of (y, x) offsets,
+    spreading the offsets across threads.
+    """
+    scores = np.empty(offsets.shape[0])
+    for i in numba.prange(offsets.shape[0]):
+        scores[i] = shift_int(template, image, offsets[i, 0], offsets[i, 1])
+    return scores
+
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def serial_shift_scores(template, image, offsets):
+    """
+    shift_scores on the calling thread only. numba's parallel kernels must
+    not be entered from several threads at once, so threads that each align
+    their own frames use this instead.
+    """
+    scores = np.empty(offsets.shape[0])
+    for i in range(offsets.shape[0]):
+        scores[i] = shift_int(template, image, offsets[i, 0], offsets[i, 1])
+    return scores
+
+
+def align_int(template, image, span=None, y_init=0, x_init=0, parallel=True):
     """
     Find integer offsets along axes 0 and 1 that align image to template. If
     the image is not aligned between guess-span and guess+span, this will
@@ -78,23 +174,17 @@ def align_int(template, image, span=None, y_init=0, x_init=0):
     span -- The size of the coordinate search space
     y0 -- A guess at the offset along axis 0
     x0 -- A guess at the offset along axis 1
+    parallel -- Spread the offsets across threads. Set this to False when
+    calling from several threads at once.
     """
     offsets = np.arange(-span, span)
+    coords = np.empty((offsets.size**2, 2), dtype=np.int64)
+    coords[:, 0] = np.repeat(y_init + offsets, offsets.size)
+    coords[:, 1] = np.tile(x_init + offsets, offsets.size)
 
-    results = []
-    coords = []
-    with ThreadPoolExecutor() as executor:
-        for y_offset in offsets:
-            for x_offset in offsets:
-                args = (template, image, y_init+y_offset, x_init+x_offset)
-                results.append(executor.submit(shift_int, *args))
-                coords.append([y_init + y_offset, x_init + x_offset])
-    results = [x.result() for x in results]
-
-    results = zip(results, coords)
+    scores = (shift_scores if parallel else serial_shift_scores)(template, image, coords)
 
-    best_result = min(results, key=operator.itemgetter(0))
-    return best_result[1]
+    return list(coords[np.argmin(scores)])
 
 
 def make_pretty(image, white_level=50):
@@ -125,45 +215,387 @@ def align(template, image):
     of small artifacts such as hot pixels or cosmic rays but may erase
     small features
 
+    To align many images to one template, use an Aligner instead.
+
     Arguments:
     template -- The image to match
     image -- The input image that is shifted
     """
-    clipped_template = make_pretty(template)
-    clipped_image = make_pretty(image)
+    return Aligner(template).align(image)
 
-    small_template = median_downsample(clipped_template, 10)
-    small_image = median_downsample(clipped_image, 10)
-    span = min(small_image.shape) // 4
-    y, x = align_int(small_template, small_image, span)
 
-    y, x = y*5, x*5
-    small_template = median_downsample(clipped_template, 2)
-    small_image = median_downsample(clipped_image, 2)
-    span = 10
-    y, x = align_int(small_template, small_image, span, y, x)
+def template_spectrum(template):
+    """Fourier transform a template for use with phase_correlate.
 
-    y, x = y*2, x*2
-    span = 4
-    y, x = align_int(clipped_template, clipped_image, span, y, x)
+    Computing this once per template means that aligning each image costs
+    one forward FFT of the image and two inverse FFTs.
+    """
+    return np.fft.rfft2(make_pretty(template))
 
-    return (y, x), shift(image, [y, x], order=0, prefilter=False)
 
+def peak_offset(lower, center, upper):
+    """Subpixel position of a peak relative to its central sample, from a
+    Gaussian through three samples, or 0 if they do not form a peak"""
+    if min(lower, center, upper) <= 0:
+        return 0.0
+    lower, center, upper = np.log([lower, center, upper])
+    curvature = lower - 2*center + upper
+    if not curvature < 0:
+        return 0.0
+    return 0.5 * (lower - upper) / curvature
 
-if __name__ == '__main__':
+
+def phase_correlate(spectrum, image):
+    """Find the subpixel offsets along axes 0 and 1 that align image to the
+    template whose transform is spectrum.
+
+    The normalized cross-power spectrum of the two images transforms back
+    into a correlation surface with one sharp peak at the offset, which is
+    robust to background and noise but too narrow to interpolate. The
+    subpixel position is instead found by fitting a Gaussian along each axis
+    to the plain cross-correlation around that peak. Offsets are only found
+    modulo the image size, so they must be less than half of it.
+
+    Arguments:
+    spectrum -- The template's transform from template_spectrum
+    image -- The input image that is shifted
+    """
+    h, w = image.shape
+    cross = spectrum * np.conj(np.fft.rfft2(make_pretty(image)))
+    phase = np.fft.irfft2(cross / (np.abs(cross) + np.finfo(float).tiny), s=image.shape)
+    y, x = np.unravel_index(np.argmax(phase), phase.shape)
+
+    correlation = np.fft.irfft2(cross, s=image.shape)
+    rows, cols = np.arange(y-1, y+2) % h, np.arange(x-1, x+2) % w
+    neighborhood = correlation[np.ix_(rows, cols)]
+    row, col = np.unravel_index(np.argmax(neighborhood), neighborhood.shape)
+    y, x = rows[row], cols[col]
+
+    dy = peak_offset(correlation[y-1, x], correlation[y, x], correlation[(y+1) % h, x])
+    dx = peak_offset(correlation[y, x-1], correlation[y, x], correlation[y, (x+1) % w])
+
+    # Peaks past the middle of the surface are negative offsets that wrapped around
+    y = y - h if y > h//2 else y
+    x = x - w if x > w//2 else x
+    return y + dy, x + dx
+
+
+def align_fft(template, image, spectrum=None, order=1):
+    """Find the subpixel offsets that align an image to a template by phase
+    correlation, and shift the image by them.
+
+    This is much faster than align and does not need a search span, but is
+    less robust when the images share little of their field.
+
+    Arguments:
+    template -- The image to match
+    image -- The input image that is shifted
+    spectrum -- The template's transform from template_spectrum, to avoid
+    recomputing it when aligning many images to one template
+    order -- The spline order used to resample the shifted image
+    """
+    if spectrum is None:
+        spectrum = template_spectrum(template)
+    y, x = phase_correlate(spectrum, image)
+    return (y, x), shift(image, [y, x], order=order)
+
+
+class Aligner:
+    """
+    Align many images to one template, preparing the template only once.
+
+    The template's pyramid of clipped and downsampled images (for the
+    'pyramid' engine used by align) or its Fourier transform (for the 'fft'
+    engine used by align_fft) is computed when the Aligner is made, so each
+    call only pays for the work on the image.
+    """
+    def __init__(self, template, engine='pyramid', parallel=True):
+        """
+        Arguments:
+        template -- The image to match
+        engine -- 'pyramid' for the brute-force integer search of align, or
+        'fft' for the subpixel phase correlation of align_fft
+        parallel -- Spread each brute-force search across threads. Set this
+        to False when calling from several threads at once.
+        """
+        if engine not in ('pyramid', 'fft'):
+            raise ValueError("engine must be 'pyramid' or 'fft', not {!r}".format(engine))
+        self.engine = engine
+        self.parallel = parallel
+
+        if engine == 'pyramid':
+            clipped_template = make_pretty(template)
+            self.pyramid = {
+                1: clipped_template,
+                2: median_downsample(clipped_template, 2),
+                10: median_downsample(clipped_template, 10),
+            }
+        else:
+            self.spectrum = template_spectrum(template)
+
+    def offset(self, image):
+        """Find the coordinate offsets that align an image to the template"""
+        if self.engine == 'fft':
+            return phase_correlate(self.spectrum, image)
+
+        clipped_image = make_pretty(image)
+
+        small_image = median_downsample(clipped_image, 10)
+        span = min(small_image.shape) // 4
+        y, x = align_int(self.pyramid[10], small_image, span, parallel=self.parallel)
+
+        y, x = y*5, x*5
+        small_image = median_downsample(clipped_image, 2)
+        span = 10
+        y, x = align_int(self.pyramid[2], small_image, span, y, x, self.parallel)
+
+        y, x = y*2, x*2
+        span = 4
+        y, x = align_int(self.pyramid[1], clipped_image, span, y, x, self.parallel)
+
+        return y, x
+
+    def align(self, image):
+        """Find the offsets that align an image to the template and shift it
+        by them. Returns the offsets and the shifted image like align."""
+        y, x = self.offset(image)
+        if self.engine == 'fft':
+            return (y, x), shift(image, [y, x], order=1)
+        return (y, x), shift(image, [y, x], order=0, prefilter=False)
+
+    def align_many(self, images, hdu_num=0):
+        """Align a sequence of images one at a time, yielding the offsets and
+        shifted image for each.
+
+        Arguments:
+        images -- An iterable of arrays or of paths to fits files, which are
+        only read when they are reached
+        hdu_num -- The HDU to read the image from when given paths
+        """
+        for image in read_images(images, hdu_num):
+            yield self.align(image)
+
+
+def read_images(images, hdu_num=0):
+    """Yield each of an iterable of arrays or of paths to fits files as an
+    array, reading each file only when it is reached"""
+    for image in images:
+        if isinstance(image, str):
+            from astropy.io import fits
+            image = fits.getdata(image, hdu_num)
+        yield image
+
+
+def triangle_invariants(positions, neighbors=4):
+    """Describe the triangles formed by each star and its nearest neighbors
+
+    Each triangle's vertices are put in a canonical order (opposite its
+    shortest, middle and longest side) and it is described by the ratios of
+    its longest to middle and middle to shortest sides, which do not change
+    under translation, rotation or scaling.
+
+    Arguments:
+    positions -- An (n, 2) array of star positions
+    neighbors -- How many nearest neighbors of each star to build triangles from
+
+    Returns an (m, 2) array of invariants and an (m, 3) array of the star
+    indices of each triangle's vertices in canonical order.
+    """
+    neighbors = min(neighbors, len(positions) - 1)
+    _, nearest = scipy.spatial.cKDTree(positions).query(positions, neighbors + 1)
+
+    triangles = set()
+    for group in nearest:
+        triangles.update(tuple(sorted(triangle)) for triangle in itertools.combinations(group, 3))
+    triangles = np.array(sorted(triangles)).reshape(-1, 3)
+
+    # sides[:, i] is the side opposite vertex i
+    corners = positions[triangles]
+    sides = np.stack([np.hypot(*(corners[:, (i+1) % 3] - corners[:, (i+2) % 3]).T) for i in range(3)], axis=1)
+    order = np.argsort(sides, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    triangles = np.take_along_axis(triangles, order, axis=1)
+
+    keep = sides[:, 0] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        invariants = np.column_stack((sides[:, 2] / sides[:, 1], sides[:, 1] / sides[:, 0]))
+    return invariants[keep], triangles[keep]
+
+
+def fit_similarity(source, destination):
+    """Least-squares rotation, scale and translation from one set of (y, x)
+    points onto another
+
+    Returns the 2x2 matrix and offset that map source points p onto
+    destination points as matrix @ p + offset.
+    """
+    # Treating (y, x) as x + iy turns the transform into one complex product
+    source_mean = source.mean(axis=0)
+    destination_mean = destination.mean(axis=0)
+    a = (source[:, 1] - source_mean[1]) + 1j*(source[:, 0] - source_mean[0])
+    b = (destination[:, 1] - destination_mean[1]) + 1j*(destination[:, 0] - destination_mean[0])
+    c = np.sum(np.conj(a) * b) / np.sum(np.abs(a)**2)
+
+    matrix = np.array([[c.real, c.imag], [-c.imag, c.real]])
+    offset = destination_mean - matrix @ source_mean
+    return matrix, offset
+
+
+def match_stars(template_positions, image_positions, template_invariants=None, tolerance=0.01, max_distance=2.,
+                trials=50):
+    """Find the rotation, scale and translation that map template star
+    positions onto image star positions
+
+    Triangles with nearly equal invariants are candidate matches. The
+    transform implied by each of the closest candidates is scored by how
+    many stars it maps to within max_distance pixels of a star, and the best
+    one is refit to all of those stars.
+
+    Arguments:
+    template_invariants -- The result of triangle_invariants for the template
+    positions, to avoid recomputing it for every image
+    tolerance -- The largest difference in invariants between matching triangles
+    max_distance -- The largest error in pixels for a pair of stars to match
+    trials -- How many candidate triangle matches to try
+
+    Returns the matrix and offset from fit_similarity and the number of
+    stars that match.
+    """
+    if template_invariants is None:
+        template_invariants = triangle_invariants(template_positions)
+    invariants, triangles = template_invariants
+    image_invariants, image_triangles = triangle_invariants(image_positions)
+
+    distance, index = scipy.spatial.cKDTree(invariants).query(image_invariants, distance_upper_bound=tolerance)
+    candidates = np.argsort(distance)[:trials]
+    candidates = candidates[np.isfinite(distance[candidates])]
+    if candidates.size == 0:
+        raise ValueError('No matching star triangles were found')
+
+    image_tree = scipy.spatial.cKDTree(image_positions)
+    best_count = 0
+    for candidate in candidates:
+        source = template_positions[triangles[index[candidate]]]
+        destination = image_positions[image_triangles[candidate]]
+        matrix, offset = fit_similarity(source, destination)
+
+        mapped = template_positions @ matrix.T + offset
+        error, nearest = image_tree.query(mapped, distance_upper_bound=max_distance)
+        matched = np.isfinite(error)
+        if matched.sum() > best_count:
+            best_count = matched.sum()
+            best = template_positions[matched], image_positions[nearest[matched]]
+
+    if best_count < 3:
+        raise ValueError('Too few stars matched to solve for a transform')
+    matrix, offset = fit_similarity(*best)
+    return matrix, offset, best_count
+
+
+class StarAligner:
+    """
+    Register images to a template with subpixel translation, rotation and
+    scale by matching the triangles formed by their brightest stars.
+
+    The template's stars and triangles are found once. Each image costs a
+    star detection, a triangle match that takes milliseconds even with
+    hundreds of stars, and a single resampling pass.
+
+    It is used like an Aligner, but its solutions are affine transforms
+    rather than (y, x) offsets, so it has transform in place of offset.
+    """
+    def __init__(self, template, nstars=50, order=3, **detect_options):
+        """
+        Arguments:
+        template -- The image to match
+        nstars -- How many of the brightest stars to match
+        order -- The spline order used to resample aligned images
+        detect_options -- Other keyword arguments for detection.find_stars
+        """
+        self.nstars = nstars
+        self.order = order
+        self.detect_options = detect_options
+        self.stars = self.detect(template)
+        self.invariants = triangle_invariants(self.stars)
+
+    def detect(self, image):
+        """The (n, 2) array of (y, x) positions of the brightest nstars stars
+        in an image, brightest first"""
+        stars = find_stars(image, **self.detect_options)[:self.nstars]
+        return np.column_stack((stars['y'], stars['x']))
+
+    def transform(self, image):
+        """Find the matrix and offset that map template coordinates p onto
+        image coordinates as matrix @ p + offset"""
+        stars = self.detect(image)
+        matrix, offset, _ = match_stars(self.stars, stars, self.invariants)
+        return matrix, offset
+
+    def align(self, image):
+        """Find the transform that aligns an image to the template and
+        resample the image onto the template's pixels with it. Returns the
+        matrix, offset and the resampled image."""
+        matrix, offset = self.transform(image)
+        aligned = scipy.ndimage.affine_transform(image, matrix, offset, order=self.order)
+        return (matrix, offset), aligned
+
+    def align_many(self, images, hdu_num=0):
+        """Align a sequence of images one at a time like Aligner.align_many,
+        yielding the transform and resampled image for each."""
+        for image in read_images(images, hdu_num):
+            yield self.align(image)
+
+
+def align_sequence(paths, template, workers=None, engine='pyramid', write=False, hdu_num=0):
+    """
+    Align a sequence of fits files to a template, spreading whole frames
+    across threads. The alignment kernels release the GIL, so the threads
+    run on separate cores.
+
+    Arguments:
+    paths -- The fits files to align
+    template -- The image to match, or the path to a fits file holding it
+    workers -- The number of frames aligned at once, by default one per core
+    engine -- 'pyramid' or 'fft', see Aligner
+    write -- Also save each aligned image next to its input, with
+    _aligned appended to its name
+    hdu_num -- The HDU holding the image in each file
+
+    Returns a structured array with the path and the y and x offsets of each
+    frame, in the order of paths.
+    """
     from astropy.io import fits
 
-    data_dir = '/home/ben/photometry_practice/'
-    paths = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith('.fits')]
-    paths.sort()
-    template = fits.getdata(paths[0])
+    if isinstance(template, str):
+        template = fits.getdata(template, hdu_num)
+    if workers is None:
+        workers = os.cpu_count()
+    # With one worker the brute-force search itself can use every core
+    aligner = Aligner(template, engine, parallel=(workers == 1))
+
+    def align_file(path):
+        with fits.open(path) as hdulist:
+            offset, aligned = aligner.align(hdulist[hdu_num].data)
+            if write:
+                hdulist[hdu_num].data = aligned
+                hdulist.writeto(path.replace('.fits', '_aligned.fits'), overwrite=True)
+        return offset
 
-    for path in paths[1:]:
-        hdulist = fits.open(path)
-        image = hdulist[0].data
+    with ThreadPoolExecutor(workers) as executor:
+        offsets = list(executor.map(align_file, paths))
 
-        offset, aligned = align(template, image)
+    table = np.empty(len(paths), dtype=[('path', 'U{}'.format(max(map(len, paths), default=1))),
+                                        ('y', float), ('x', float)])
+    table['path'] = paths
+    table['y'] = [y for y, x in offsets]
+    table['x'] = [x for y, x in offsets]
+    return table
 
-        save_name = path.replace('.fits', '_aligned.fits')
-        hdulist[0].data = aligned
-        hdulist.writeto(save_name, overwrite=True)
+
+if __name__ == '__main__':
+    data_dir = '/home/ben/photometry_practice/'
+    paths = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith('.fits')]
+    paths.sort()
+    offsets = align_sequence(paths[1:], paths[0], write=True)
+    for path, y, x in offsets:
+        print(path, y, x)
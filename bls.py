@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Box Least Squares (Kovacs, Zucker & Mazeh 2002) search for periodic
+transits in a light curve.
+
+At each trial period the light curve is folded into phase bins fine enough
+to resolve the shortest trial duration. Cumulative sums of the binned
+weights and fluxes then give the fit of every box, at every starting bin
+and duration, in constant time. The periods are spread across threads.
+
+box_least_squares -- The best box at each trial period
+serial_box_least_squares -- box_least_squares on the calling thread only
+transit_search -- The best transit over a grid of periods and durations
+"""
+
+import numpy as np
+import numba
+
+from stats import mad
+
+
+# Trial transit durations in days, from short-period hot Jupiters to
+# planets on orbits of a few hundred days
+DURATIONS = (0.04, 0.08, 0.12, 0.16, 0.25, 0.33, 0.5)
+
+BLS_DTYPE = np.dtype([
+    ('period', np.float64),
+    ('power', np.float64),
+    ('t0', np.float64),
+    ('duration', np.float64),
+    ('depth', np.float64),
+    ('snr', np.float64),
+])
+
+
+@numba.jit(nopython=True, cache=True, nogil=True, parallel=True)
+def box_least_squares(time, flux, weights, periods, durations, oversample=3):
+    """
+    Fit a box-shaped dip at every trial period.
+
+    The fluxes must have zero weighted mean and the weights must sum to 1.
+    The power of a box holding a fraction r of the weight and a weighted
+    flux sum s is s**2 / (r*(1 - r)), and its depth is -s / (r*(1 - r)).
+    Only dips are considered.
+
+    Arguments:
+    time -- Times of the observations
+    flux -- Centered fluxes
+    weights -- Normalized weight of each observation
+    periods -- Trial periods
+    durations -- Trial durations, in the units of time
+    oversample -- Phase bins across the shortest duration
+
+    Returns arrays of the power, mid-transit time, duration and depth of
+    the best box at each period. Periods no duration fits in get zeros.
+    """
+    power = np.zeros(periods.size)
+    t0 = np.zeros(periods.size)
+    best_duration = np.zeros(periods.size)
+    depth = np.zeros(periods.size)
+    reference = time.min()
+    shortest = durations.min()
+
+    for p in numba.prange(periods.size):
+        period = periods[p]
+        frequency = 1 / period
+        nbins = int(np.ceil(period * oversample / shortest))
+
+        binned_weight = np.zeros(nbins)
+        binned_flux = np.zeros(nbins)
+        for i in range(time.size):
+            cycles = (time[i] - reference) * frequency
+            phase_bin = min(nbins - 1, int((cycles - np.floor(cycles)) * nbins))
+            binned_weight[phase_bin] += weights[i]
+            binned_flux[phase_bin] += weights[i] * flux[i]
+
+        # Cumulative sums run twice around the phase so boxes can wrap
+        cumulative_weight = np.zeros(2*nbins + 1)
+        cumulative_flux = np.zeros(2*nbins + 1)
+        for b in range(2*nbins):
+            cumulative_weight[b + 1] = cumulative_weight[b] + binned_weight[b % nbins]
+            cumulative_flux[b + 1] = cumulative_flux[b] + binned_flux[b % nbins]
+
+        for duration in durations:
+            width = max(1, int(round(duration * nbins / period)))
+            if width >= nbins:
+                continue
+            for start in range(nbins):
+                r = cumulative_weight[start + width] - cumulative_weight[start]
+                s = cumulative_flux[start + width] - cumulative_flux[start]
+                if s >= 0 or r <= 0 or r >= 1:
+                    continue
+                box_power = s * s / (r * (1 - r))
+                if box_power > power[p]:
+                    power[p] = box_power
+                    t0[p] = reference + ((start + width / 2) / nbins % 1) * period
+                    best_duration[p] = width * period / nbins
+                    depth[p] = -s / (r * (1 - r))
+
+    return power, t0, best_duration, depth
+
+
+# For transit_search(parallel=False), which is safe to call from several
+# threads at once. Without parallel=True the prange loop runs serially. It is
+# not cached because numba's cache key ignores parallel=True, so the two
+# kernels compiled from one source would load each other from disk.
+serial_box_least_squares = numba.jit(nopython=True, cache=False, nogil=True)(box_least_squares.py_func)
+
+
+def transit_search(time, flux, periods, durations=DURATIONS, flux_err=None, oversample=3, parallel=True):
+    """Find the most significant periodic transit in a light curve
+
+    Arguments:
+    time -- Times of the observations
+    flux -- Fluxes of the observations
+    periods -- Trial periods, in the units of time
+
+    Keyword arguments:
+    durations -- Trial transit durations, in the units of time
+    flux_err -- Uncertainty of each flux. By default every point gets the
+    scatter of the light curve, estimated from its median absolute
+    deviation so the transits themselves barely inflate it.
+    oversample -- Phase bins across the shortest duration
+    parallel -- Spread the periods across threads. Set this to False when
+    calling from several threads at once.
+
+    Returns the best row and the whole periodogram as BLS_DTYPE arrays with
+    the period, power, mid-transit time, duration, depth and signal-to-noise
+    ratio of the best box at each period. The signal-to-noise ratio is the
+    depth over its uncertainty, which is sqrt(power * total weight).
+    """
+    time = np.asarray(time, dtype=np.float64)
+    flux = np.asarray(flux, dtype=np.float64)
+    periods = np.asarray(periods, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.float64)
+
+    if flux_err is None:
+        flux_err = np.full(flux.size, 1.4826 * mad(flux))
+    inverse_variance = 1 / np.asarray(flux_err, dtype=np.float64)**2
+    total_weight = inverse_variance.sum()
+    weights = inverse_variance / total_weight
+    centered = flux - np.sum(weights * flux)
+
+    search = box_least_squares if parallel else serial_box_least_squares
+    power, t0, duration, depth = search(time, centered, weights, periods, durations, oversample)
+
+    periodogram = np.empty(periods.size, dtype=BLS_DTYPE)
+    periodogram['period'] = periods
+    periodogram['power'] = power
+    periodogram['t0'] = t0
+    periodogram['duration'] = duration
+    periodogram['depth'] = depth
+    periodogram['snr'] = np.sqrt(power * total_weight)
+    return periodogram[np.argmax(power)], periodogram
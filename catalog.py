@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+A compact on-disk format for the star fits of vectorize_starfield, meant for
+keeping every star of a night's frames without keeping the frames.
+
+A catalog is a fits file whose primary header records the source image,
+the PSF model, when it was written and how the stars are indexed, and
+whose STARS extension is a table of float32 columns. The stars are stored
+sorted into square cells of the image, and a sidecar .idx.npy file holds
+where each cell's rows start, so the stars in any region are one slice of
+the table. Both files are memory-mapped when read.
+
+CATALOG_DTYPE -- The columns of a catalog
+catalog_rows -- Convert PSF fits to catalog rows
+write_catalog -- Write PSF fits of one image as a catalog
+StarCatalog -- Memory-mapped access to a catalog and its spatial index
+cross_match -- Pair stars in one catalog with the nearest star in another
+"""
+
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+from astropy.io import fits
+import scipy.spatial
+
+
+# Big-endian like the fits table, so the table is used without conversion
+CATALOG_DTYPE = np.dtype([(name, '>f4') for name in
+                          ('y', 'x', 'flux', 'height', 'width', 'sky',
+                           'y_err', 'x_err', 'height_err', 'width_err', 'sky_err', 'chi2')])
+
+CELL_SIZE = 64
+
+
+def index_path(path):
+    """The path of the spatial index sidecar of the catalog at path"""
+    return os.path.splitext(path)[0] + '.idx.npy'
+
+
+def catalog_rows(fit):
+    """
+    Catalog rows from a vectorize_starfield.PSF_DTYPE array. The flux is the
+    integral of the fitted Gaussian. Stars that could not be fit are left out.
+    """
+    fit = fit[np.isfinite(fit['y']) & np.isfinite(fit['x'])]
+    rows = np.empty(fit.size, dtype=CATALOG_DTYPE)
+    for name in CATALOG_DTYPE.names:
+        if name != 'flux':
+            rows[name] = fit[name]
+    rows['flux'] = 2*np.pi * fit['height'] * fit['width']**2
+    return rows
+
+
+def write_catalog(path, fit, source, shape, psf='gaussian', cell_size=CELL_SIZE):
+    """
+    Write the PSF fits of the stars of one image as a catalog and its
+    spatial index. Both files are written under temporary names and moved
+    into place, so a reader never sees a partial catalog.
+
+    Arguments:
+    path -- Where to write the catalog
+    fit -- vectorize_starfield.PSF_DTYPE array of the stars
+    source -- The path of the image the stars were found in
+    shape -- The shape of that image
+
+    Keyword arguments:
+    psf -- The name of the PSF model the stars were fit with
+    cell_size -- Side of the square cells of the spatial index in pixels
+    """
+    rows = catalog_rows(fit)
+    ncells = (-(-shape[0] // cell_size), -(-shape[1] // cell_size))
+
+    cell_y = np.clip(rows['y'] // cell_size, 0, ncells[0] - 1).astype(np.int64)
+    cell_x = np.clip(rows['x'] // cell_size, 0, ncells[1] - 1).astype(np.int64)
+    cell = cell_y * ncells[1] + cell_x
+    order = np.argsort(cell, kind='stable')
+    rows = rows[order]
+    offsets = np.zeros(ncells[0]*ncells[1] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cell, minlength=ncells[0]*ncells[1]), out=offsets[1:])
+
+    header = fits.Header()
+    header['SOURCE'] = (source, 'image the stars were found in')
+    header['PSFMODEL'] = (psf, 'PSF model the stars were fit with')
+    header['DATE'] = (datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+                      'UTC time the catalog was written')
+    header['IMHEIGHT'] = (shape[0], 'rows in the source image')
+    header['IMWIDTH'] = (shape[1], 'columns in the source image')
+    header['CELLSIZE'] = (cell_size, 'side of the spatial index cells in pixels')
+    header['NSTARS'] = (rows.size, 'stars in the catalog')
+
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=header), fits.BinTableHDU(rows, name='STARS')])
+    hdulist.writeto(path + '.tmp', overwrite=True, output_verify='exception')
+    with open(index_path(path) + '.tmp', 'wb') as f:
+        np.save(f, offsets)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+    os.replace(path + '.tmp', path)
+
+
+class StarCatalog:
+    """
+    A catalog written by write_catalog, with its header, its memory-mapped
+    stars and region queries through its spatial index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hdulist = fits.open(path, memmap=True)
+        self.header = self.hdulist[0].header
+        self.stars = self.hdulist['STARS'].data
+        self.offsets = np.load(index_path(path), mmap_mode='r')
+
+        self.cell_size = self.header['CELLSIZE']
+        self.shape = (self.header['IMHEIGHT'], self.header['IMWIDTH'])
+        self.ncells = (-(-self.shape[0] // self.cell_size), -(-self.shape[1] // self.cell_size))
+
+    def __len__(self):
+        return len(self.stars)
+
+    def cell_rows(self, cell_y, cell_x):
+        """The slice of the table holding the stars of one cell"""
+        cell = cell_y * self.ncells[1] + cell_x
+        return slice(int(self.offsets[cell]), int(self.offsets[cell + 1]))
+
+    def region_rows(self, y0, y1, x0, x1):
+        """
+        The table rows of every cell that overlaps the region, which holds
+        every star in it and some around it.
+        """
+        cells_y = range(max(0, int(y0 // self.cell_size)), min(self.ncells[0], int(y1 // self.cell_size) + 1))
+        cells_x = range(max(0, int(x0 // self.cell_size)), min(self.ncells[1], int(x1 // self.cell_size) + 1))
+        # The cells of one row of the grid are adjacent in the table
+        slices = [slice(self.cell_rows(cell_y, cells_x[0]).start, self.cell_rows(cell_y, cells_x[-1]).stop)
+                  for cell_y in cells_y if len(cells_x)]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(s.start, s.stop) for s in slices])
+
+    def region(self, y0, y1, x0, x1):
+        """The stars with y0 <= y < y1 and x0 <= x < x1"""
+        stars = self.stars[self.region_rows(y0, y1, x0, x1)]
+        inside = (stars['y'] >= y0) & (stars['y'] < y1) & (stars['x'] >= x0) & (stars['x'] < x1)
+        return stars[inside]
+
+    def close(self):
+        self.hdulist.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def cross_match(catalog, y, x, radius=1.):
+    """
+    The row in a catalog of the nearest star to each (y, x) position within
+    radius pixels, or -1 where there is none. Positions are matched one row
+    of index cells at a time against the stars in that row and the rows on
+    either side, which are one slice of the table, so only those parts of
+    the catalog are read at once.
+
+    Arguments:
+    catalog -- A StarCatalog
+    y, x -- Positions to match, such as the stars of another catalog
+    radius -- The farthest a match may be, at most the catalog's cell size
+    """
+    if radius > catalog.cell_size:
+        raise ValueError('radius {} is larger than the cell size {}'.format(radius, catalog.cell_size))
+    y, x = np.asarray(y, dtype=np.float64), np.asarray(x, dtype=np.float64)
+    match = np.full(y.size, -1, dtype=np.int64)
+
+    cell_y = np.floor(y / catalog.cell_size).astype(np.int64)
+    order = np.argsort(cell_y, kind='stable')
+    rows, starts = np.unique(cell_y[order], return_index=True)
+    for row, group in zip(rows, np.split(order, starts[1:])):
+        first = int(catalog.offsets[min(max(row - 1, 0), catalog.ncells[0]) * catalog.ncells[1]])
+        last = int(catalog.offsets[min(max(row + 2, 0), catalog.ncells[0]) * catalog.ncells[1]])
+        if first == last:
+            continue
+        tree = scipy.spatial.cKDTree(np.column_stack((catalog.stars.field('y')[first:last],
+                                                      catalog.stars.field('x')[first:last])))
+        distance, nearest = tree.query(np.column_stack((y[group], x[group])), distance_upper_bound=radius)
+        found = np.isfinite(distance)
+        match[group[found]] = first + nearest[found]
+    return match
@@ -1,28 +1,135 @@
+#!/usr/bin/env python
+"""
+Benchmark combining a stack of images with different memory layouts, data
+types and combine methods, to catch performance regressions in
+MaximDL_dataproc.median_combine.
+
+Every combination of image size, frame count, dtype, layout and method is
+run and reported as a JSON list of records with the wall time in seconds
+(best of --repeat runs), the peak memory allocated by numpy during one run
+in bytes, and the throughput in stacked pixels per second.
+
+Layouts:
+list_comp -- build the stack with np.array from a list of images
+last_axis -- fill an (height, width, frames) stack and combine along the last axis
+first_axis -- fill a (frames, height, width) stack and combine along the first axis
+
+For help on command line arguments:
+> python combine_images.py -h
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+import tracemalloc
+
 import numpy as np
 
+from MaximDL_dataproc import COMBINE_METHODS, combine_stack
+
 
-@profile
-def list_comp():
-    return np.median(np.moveaxis(np.array([image for _ in range(nimages)]), 0, 2), axis=-1)
+def list_comp(images):
+    return np.array(images)
 
 
-@profile
-def last_axis():
-    stack = np.zeros(image.shape + (nimages,))
-    for i in range(nimages):
+def last_axis(images):
+    stack = np.empty(images[0].shape + (len(images),), images[0].dtype)
+    for i, image in enumerate(images):
         stack[..., i] = image
-    return np.median(stack, axis=-1, overwrite_input=True)
+    return np.moveaxis(stack, -1, 0)
 
 
-@profile
-def first_axis():
-    stack = np.zeros((nimages,) + image.shape)
-    for i in range(nimages):
+def first_axis(images):
+    stack = np.empty((len(images),) + images[0].shape, images[0].dtype)
+    for i, image in enumerate(images):
         stack[i] = image
-    return np.median(stack, axis=0, overwrite_input=True)
+    return stack
+
+
+LAYOUTS = {
+    'list_comp': list_comp,
+    'last_axis': last_axis,
+    'first_axis': first_axis,
+}
+
+DTYPES = ['int16', 'uint16', 'float32', 'float64']
+
+
+def make_images(size, nframes, dtype):
+    """Random images that fill a useful part of an integer dtype's range"""
+    images = np.random.normal(1000, 100, (nframes, size, size))
+    return list(images.astype(dtype))
+
+
+def run(images, layout, method):
+    combined, _ = combine_stack(LAYOUTS[layout](images), method)
+    return combined
+
+
+def benchmark(size, nframes, dtype, layout, method, repeat=3):
+    """Time and measure one combination, returning a JSON-ready dict"""
+    images = make_images(size, nframes, dtype)
+
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(images, layout, method)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    # Measured separately so that tracing does not slow down the timed runs
+    tracemalloc.start()
+    run(images, layout, method)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'size': size, 'frames': nframes, 'dtype': dtype, 'layout': layout, 'method': method,
+            'seconds': seconds, 'peak_bytes': peak, 'pixels_per_second': size*size*nframes / seconds}
+
+
+def find_regressions(results, baseline, tolerance):
+    """Records in results that are more than tolerance (a fraction) slower
+    than the matching record in baseline"""
+    fields = ('size', 'frames', 'dtype', 'layout', 'method')
+    previous = {tuple(record[field] for field in fields): record for record in baseline}
+    regressions = []
+    for record in results:
+        old = previous.get(tuple(record[field] for field in fields))
+        if old is not None and record['seconds'] > old['seconds'] * (1 + tolerance):
+            regressions.append({'record': record, 'baseline_seconds': old['seconds']})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark image stack combining.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024], help='image side lengths in pixels')
+    parser.add_argument('--frames', type=int, nargs='+', default=[10, 100], help='numbers of frames to combine')
+    parser.add_argument('--dtypes', nargs='+', default=DTYPES, choices=DTYPES)
+    parser.add_argument('--layouts', nargs='+', default=sorted(LAYOUTS), choices=sorted(LAYOUTS))
+    parser.add_argument('--methods', nargs='+', default=sorted(COMBINE_METHODS), choices=sorted(COMBINE_METHODS))
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each combination')
+    parser.add_argument('-o', '--output', default=None, help='file to write the JSON results to instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of an earlier run. Exits with status 1 if any combination got slower.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a combination may slow down relative to the baseline')
+    args = parser.parse_args()
 
+    np.random.seed(0)
+    results = [benchmark(*combination, repeat=args.repeat) for combination in
+               itertools.product(args.sizes, args.frames, args.dtypes, args.layouts, args.methods)]
 
-image = np.random.rand(1024, 1024)
-nimages = 100
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
 
-print(np.all(last_axis() == list_comp()))
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            json.dump(regressions, sys.stderr, indent=1)
+            print(file=sys.stderr)
+            sys.exit(1)
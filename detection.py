@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Find the stars in an image. The image is convolved with a Gaussian matched
+to the PSF, stars are the pixels of the filtered image that are the
+brightest in their box and significantly above the sky, and stars that
+share one connected region above the threshold are deblended by giving
+each region pixel to its nearest star.
+
+The convolution and peak search run in overlapping bands of rows spread
+across threads. scipy.ndimage releases the GIL, so the bands run on every
+core at once.
+
+estimate_sky -- Robust sky level and noise from a subsample of the pixels
+filter_noise -- How much the matched filter scales white noise
+detect_band -- Matched filter and local maxima of one band of an image
+deblend -- Share the pixels of connected regions between their stars
+find_stars -- Catalog of the stars in an image
+
+For help on command line arguments:
+> python detection.py -h
+"""
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+
+from stats import mad
+
+
+# Width of the matched filter kernel in standard deviations on either side
+TRUNCATE = 4.0
+
+STAR_DTYPE = np.dtype([
+    ('y', np.float64),
+    ('x', np.float64),
+    ('peak', np.float64),
+    ('flux', np.float64),
+    ('area', np.int64),
+    ('snr', np.float64),
+    ('component', np.int64),
+    ('blend', np.int64),
+])
+
+
+def estimate_sky(image, step=4):
+    """
+    The median and the standard deviation estimated from the median
+    absolute deviation of every step'th pixel along each axis. Stars
+    barely move either statistic, and subsampling keeps this cheap on
+    large frames.
+    """
+    sample = image[::step, ::step]
+    return float(np.median(sample)), 1.4826 * float(mad(sample))
+
+
+def filter_noise(smoothing):
+    """
+    The standard deviation of white noise of unit standard deviation
+    after the matched filter. The kernel is separable and normalized, so
+    this is the sum of the squared 1-d weights.
+    """
+    radius = int(TRUNCATE * smoothing + 0.5)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / smoothing)**2)
+    kernel /= kernel.sum()
+    return float(np.sum(kernel**2))
+
+
+def detect_band(image, smooth, start, stop, sky, level, smoothing, box):
+    """
+    Filter rows start:stop of an image into the same rows of smooth and
+    return the (y, x) pixel coordinates of the stars in them.
+
+    Enough rows on either side are filtered along with the band that the
+    result does not depend on where the bands are split.
+
+    Arguments:
+    image -- The image to search
+    smooth -- Output array the shape of the image for the filtered image,
+    with the sky subtracted
+    start -- First row of the band
+    stop -- Row after the last row of the band
+    sky -- Sky level to subtract
+    level -- Threshold above the sky in the filtered image
+    smoothing -- The standard deviation of the matched filter in pixels
+    box -- The side of the square a star must be the brightest pixel in
+    """
+    halo = int(TRUNCATE * smoothing + 0.5) + box//2
+    low, high = max(0, start - halo), min(image.shape[0], stop + halo)
+
+    tile = scipy.ndimage.gaussian_filter(image[low:high], smoothing, truncate=TRUNCATE)
+    tile -= sky
+    peaks = (tile == scipy.ndimage.maximum_filter(tile, box)) & (tile > level)
+
+    smooth[start:stop] = tile[start-low:stop-low]
+    y, x = np.nonzero(peaks[start-low:stop-low])
+    return y + start, x
+
+
+def deblend(labels, y, x):
+    """
+    Give every labelled pixel to a star in its connected region. Regions
+    with one star give it all of their pixels, and regions with several
+    give each pixel to the nearest star in the region.
+
+    Arguments:
+    labels -- Connected regions of an image as returned by scipy.ndimage.label
+    y, x -- Pixel coordinates of the stars
+
+    Returns the star label of each star, the coordinates of the labelled
+    pixels and the index of the star each one belongs to, which is -1 for
+    pixels of regions without a star.
+    """
+    component = labels[y, x]
+    count = np.bincount(component, minlength=labels.max() + 1)
+
+    pixel_y, pixel_x = np.nonzero(labels)
+    member = labels[pixel_y, pixel_x]
+
+    owner = np.full(count.size, -1)
+    owner[component[::-1]] = np.arange(y.size)[::-1]
+    owner = owner[member]
+
+    blended = count[member] > 1
+    if blended.any():
+        # Regions are pushed apart along a third axis so that the nearest
+        # star is always in the pixel's own region
+        scale = 2 * sum(labels.shape)
+        tree = scipy.spatial.cKDTree(np.column_stack((y, x, component * scale)))
+        _, owner[blended] = tree.query(np.column_stack(
+            (pixel_y[blended], pixel_x[blended], member[blended] * scale)), workers=-1)
+
+    return component, pixel_y, pixel_x, owner
+
+
+def find_stars(image, smoothing=1.5, threshold=5., box=5, band=512, workers=None):
+    """Find the stars in an image with subpixel positions and fluxes
+
+    Arguments:
+    image -- The image to search
+
+    Keyword arguments:
+    smoothing -- The standard deviation of the matched filter in pixels,
+    roughly the PSF width
+    threshold -- How many standard deviations of the filtered sky a star
+    must rise above it
+    box -- The side of the square a star must be the brightest pixel in
+    band -- Rows in each band given to a thread
+    workers -- Number of threads, defaults to the number of cores
+
+    Returns a STAR_DTYPE array, brightest peak first, of
+    y, x -- Subpixel position from a parabola through the filtered peak
+    peak -- Height of the filtered peak above the sky
+    flux -- Sum of the sky-subtracted pixels given to the star
+    area -- Number of pixels given to the star
+    snr -- Peak over the standard deviation of the filtered sky
+    component -- Label of the connected region the star is in
+    blend -- Number of stars in that region, 1 for an isolated star
+    """
+    image = np.asarray(image, dtype=np.float32)
+    height, width = image.shape
+    sky, noise = estimate_sky(image)
+    sigma = noise * filter_noise(smoothing)
+    level = threshold * sigma
+
+    smooth = np.empty(image.shape, dtype=np.float32)
+    starts = range(0, height, band)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        found = list(executor.map(
+            lambda start: detect_band(image, smooth, start, min(start + band, height),
+                                      sky, level, smoothing, box), starts))
+    y = np.concatenate([band_y for band_y, _ in found])
+    x = np.concatenate([band_x for _, band_x in found])
+
+    # Leave room at the edges for the parabola fit
+    inside = (y > 0) & (y < height-1) & (x > 0) & (x < width-1)
+    y, x = y[inside], x[inside]
+
+    labels, _ = scipy.ndimage.label(smooth > level, structure=np.ones((3, 3)))
+
+    # A flat top, such as a saturated star's, can tie for the maximum of
+    # several boxes. Keep one star per value in each region.
+    _, unique = np.unique(np.column_stack((labels[y, x], smooth[y, x])), axis=0, return_index=True)
+    unique.sort()
+    y, x = y[unique], x[unique]
+
+    component, pixel_y, pixel_x, owner = deblend(labels, y, x)
+    given = owner >= 0
+    flux = np.bincount(owner[given], weights=image[pixel_y[given], pixel_x[given]] - sky,
+                       minlength=y.size)
+    area = np.bincount(owner[given], minlength=y.size)
+
+    center = smooth[y, x].astype(np.float64)
+    dy_curvature = smooth[y-1, x] - 2*center + smooth[y+1, x]
+    dx_curvature = smooth[y, x-1] - 2*center + smooth[y, x+1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dy = np.where(dy_curvature < 0, 0.5 * (smooth[y-1, x] - smooth[y+1, x]) / dy_curvature, 0)
+        dx = np.where(dx_curvature < 0, 0.5 * (smooth[y, x-1] - smooth[y, x+1]) / dx_curvature, 0)
+
+    stars = np.empty(y.size, dtype=STAR_DTYPE)
+    stars['y'] = y + dy
+    stars['x'] = x + dx
+    stars['peak'] = center
+    stars['flux'] = flux
+    stars['area'] = area
+    stars['snr'] = center / sigma
+    stars['component'] = component
+    stars['blend'] = np.bincount(component)[component]
+
+    return stars[np.argsort(center)[::-1]]
+
+
+if __name__ == '__main__':
+    from astropy.io import fits
+
+    parser = argparse.ArgumentParser(description='List the stars in a fits image.')
+    parser.add_argument('image', help='fits file to search')
+    parser.add_argument('--hdu', type=int, default=0, help='HDU to read the image from')
+    parser.add_argument('-s', '--smoothing', type=float, default=1.5, help='PSF standard deviation in pixels')
+    parser.add_argument('-t', '--threshold', type=float, default=5., help='detection threshold in sky sigmas')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of threads')
+    args = parser.parse_args()
+
+    stars = find_stars(fits.getdata(args.image, args.hdu), args.smoothing, args.threshold,
+                       workers=args.workers)
+    print(' '.join(STAR_DTYPE.names))
+    for star in stars:
+        print(' '.join(str(value) for value in star))
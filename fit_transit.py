@@ -2,9 +2,21 @@ import numpy as np
 import scipy.optimize
 from scipy.signal import lombscargle
 import batman
-import ctools
 import matplotlib.pyplot as plt
 
+from bls import transit_search
+from period_grid import coarse_to_fine
+
+
+# Shortest orbital period searched, in days
+MIN_PERIOD = 0.5
+
+# Shortest transit searched at a 1 day period, in days. Transit durations
+# grow as period**(1/3), so the trial period grid is spaced for this
+# duration scaled to each period rather than for the shortest duration
+# everywhere, which would grow with the square of the baseline.
+DURATION_AT_ONE_DAY = 0.04
+
 
 def periodogram(time, data, periods):
     freq = 1/periods
@@ -26,37 +38,32 @@ def phase_dispersion_minimization(time, data, period):
 
 def fit_transit(time, flux, period=None):
 
-    if period is None:
-        time_range = time.max()-time.min()
-        avg_spacing = time_range/time.size
-        start = avg_spacing
-        stop = time_range
-
-        periods = np.arange(start, stop, avg_spacing)
-
-        phase_dispersion = ctools.phase_dispersion(time, flux, periods)
-        power = periodogram(time, flux, periods)
-        
-        period = 25.0
+    flux = flux / np.median(flux)  # Data must be normalized to use the rp parameter
 
-    time %= period
+    if period is None:
+        # Only the strongest peaks of a coarse search are searched finely
+        periods, power = coarse_to_fine(lambda periods: transit_search(time, flux, periods)[1]['power'],
+                                        time, MIN_PERIOD, duty_cycle=DURATION_AT_ONE_DAY, oversample=3,
+                                        coarsen=3, duty_exponent=2/3)
+        period = periods[np.argmax(power)]
+
+    # Seed the fit from the most significant box-shaped transit
+    best, _ = transit_search(time, flux, [period])
+    period = best['period']
+
+    # Fold so that the transit is in the middle of the light curve
+    time = (time - best['t0'] + period/2) % period
     inds = np.argsort(time, kind='mergesort')
     time = time[inds]
     flux = flux[inds]
 
-    flux /= np.median(flux)  # Data must be normalized to use the rp parameter
-
-    in_transit = flux < 1-(1-flux.min())/2
-
-    # Estimate planet radius fro mthe transit depth
-    planet_radius = np.sqrt(1-np.median(flux[in_transit]))
+    # Estimate planet radius from the transit depth
+    planet_radius = np.sqrt(max(best['depth'], 0))
 
-    # Estimate the location of the only dip
-    t0 = np.median(time[in_transit])
+    t0 = period/2
 
     # Estimate semi-major axis from transit duration
-    duration = time[in_transit].max()-time[in_transit].min()
-    semi_major_axis = 1 / np.sin(duration * np.pi / period)
+    semi_major_axis = 1 / np.sin(best['duration'] * np.pi / period)
 
     def transit_model_partial(time, *params):
         return transit_model(time, period, t0, *params)
@@ -78,6 +85,8 @@ def fit_transit(time, flux, period=None):
     #plt.plot(time, transit_model(time, *p))
     #plt.show()
 
+    # Undo the fold's shift of the epoch
+    p[1] += best['t0'] - period/2
     return p
 
 
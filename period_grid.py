@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Trial period grids for period searches such as fit_transit.periodogram,
+the ctools statistics and bls.transit_search.
+
+A signal's peak in any of these periodograms is about duty_cycle / baseline
+wide in frequency, where the duty cycle is the fraction of each period the
+signal takes up: about 1 for a sinusoid and the transit duration over the
+period for a transit. Grids are spaced by that width divided by an
+oversampling factor, so long periods are not sampled more densely than they
+can be resolved and short periods are not missed. The grid size depends on
+the baseline and the period range, not the number of points.
+
+The duty cycle may fall with the period as period**-duty_exponent. Transits
+across one star last in proportion to period**(1/3), so their duty cycle
+falls as period**(-2/3) and their grid is uniform in frequency**(1/3)
+(Ofir 2014) rather than in frequency. Keeping the duty cycle of the
+shortest transit at the shortest period everywhere instead would make the
+grid grow with the square of the baseline.
+
+frequency_step -- Frequency spacing that resolves a signal's peak
+period_grid -- Trial periods spaced to resolve every peak
+refine_grid -- Fine trial periods around the peaks of a coarse periodogram
+coarse_to_fine -- Evaluate a periodogram coarsely, then finely around its peaks
+"""
+
+import numpy as np
+
+
+def frequency_step(baseline, duty_cycle=1., oversample=5):
+    """
+    The frequency spacing that samples a peak duty_cycle / baseline wide
+    oversample times.
+    """
+    return duty_cycle / (oversample * baseline)
+
+
+def period_grid(time, min_period=None, max_period=None, duty_cycle=1., oversample=5, duty_exponent=0.):
+    """Trial periods spaced to sample every peak oversample times
+
+    Arguments:
+    time -- Times of the observations
+
+    Keyword arguments:
+    min_period -- Shortest period, by default twice the median cadence
+    max_period -- Longest period, by default half the baseline so at least
+    two cycles are observed
+    duty_cycle -- Fraction of the period the signal takes up at a period
+    of 1. For transits this is the shortest duration searched at a period
+    of 1, such as 0.04 for days.
+    oversample -- Samples across each peak
+    duty_exponent -- How fast the duty cycle falls with the period, below 1:
+    0 for a fixed duty cycle, which spaces the grid uniformly in frequency,
+    and 2/3 for transits
+
+    Returns the periods in increasing order.
+    """
+    time = np.sort(np.asarray(time, dtype=np.float64))
+    baseline = time[-1] - time[0]
+    if min_period is None:
+        min_period = 2 * np.median(np.diff(time))
+    if max_period is None:
+        max_period = baseline / 2
+
+    # The step in frequency is proportional to frequency**duty_exponent, so
+    # the step in frequency**(1 - duty_exponent) is constant
+    power = 1 - duty_exponent
+    step = power * frequency_step(baseline, duty_cycle, oversample)
+    warped = np.arange((1 / max_period)**power, (1 / min_period)**power + step/2, step)
+    return 1 / warped[::-1]**(1 / power)
+
+
+def refine_grid(periods, power, time, duty_cycle=1., oversample=5, npeaks=5, minimize=False, duty_exponent=0.):
+    """Fine trial periods around the strongest peaks of a coarse periodogram
+
+    Arguments:
+    periods -- Coarse trial periods
+    power -- The periodogram at those periods
+    time -- Times of the observations
+
+    Keyword arguments:
+    duty_cycle, duty_exponent -- As for period_grid
+    oversample -- Samples across each peak in the fine grid
+    npeaks -- How many of the strongest local extrema to refine
+    minimize -- The periodogram has minima at likely periods, like the
+    ctools statistics, instead of maxima
+
+    Returns periods in increasing order with the fine spacing at each
+    chosen peak, spanning the peak's coarse neighbors.
+    """
+    periods = np.asarray(periods, dtype=np.float64)
+    power = -np.asarray(power, dtype=np.float64) if minimize else np.asarray(power, dtype=np.float64)
+    order = np.argsort(periods)
+    frequencies, power = 1 / periods[order], power[order]
+
+    padded = np.concatenate(([-np.inf], power, [-np.inf]))
+    peaks = np.flatnonzero((power >= padded[:-2]) & (power >= padded[2:]) & np.isfinite(power))
+    peaks = peaks[np.argsort(power[peaks])[::-1][:npeaks]]
+
+    time = np.asarray(time, dtype=np.float64)
+    step = frequency_step(time.max() - time.min(), duty_cycle, oversample)
+    fine = [np.arange(frequencies[min(peak + 1, frequencies.size - 1)],
+                      frequencies[max(peak - 1, 0)] + step * frequencies[peak]**duty_exponent / 2,
+                      step * frequencies[peak]**duty_exponent) for peak in peaks]
+    if not fine:
+        return np.empty(0)
+    return np.unique(1 / np.concatenate(fine))
+
+
+def coarse_to_fine(evaluate, time, min_period=None, max_period=None, duty_cycle=1., oversample=5,
+                   coarsen=5, npeaks=5, minimize=False, duty_exponent=0.):
+    """Evaluate a periodogram on a coarse grid, then on a fine grid around its peaks
+
+    The coarse grid samples each peak oversample/coarsen times and the
+    fine grid oversample times, so with few peaks refined this costs about
+    1/coarsen of evaluating the fine grid everywhere.
+
+    Arguments:
+    evaluate -- Function of an array of periods returning the periodogram
+    at them, such as lambda periods: ctools.pdm_theta(time, flux, periods)
+    time -- Times of the observations
+
+    Keyword arguments:
+    min_period, max_period, duty_cycle, oversample, duty_exponent -- As for
+    period_grid
+    coarsen -- How much sparser the coarse grid is
+    npeaks, minimize -- As for refine_grid
+
+    Returns all the periods evaluated in increasing order and the
+    periodogram at them.
+    """
+    coarse = period_grid(time, min_period, max_period, duty_cycle, oversample / coarsen, duty_exponent)
+    coarse_power = np.asarray(evaluate(coarse))
+    fine = refine_grid(coarse, coarse_power, time, duty_cycle, oversample, npeaks, minimize, duty_exponent)
+    fine_power = np.asarray(evaluate(fine))
+
+    periods = np.concatenate((coarse, fine))
+    order = np.argsort(periods, kind='stable')
+    return periods[order], np.concatenate((coarse_power, fine_power))[order]
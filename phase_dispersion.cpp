@@ -1,6 +1,11 @@
 #include <iostream>
 #include <vector>
 #include <algorithm>
+#include <thread>
+#include <functional>
+#include <exception>
+#include <stdexcept>
+#include <cmath>
 #include <Python.h>
 #define NPY_NO_DEPRECATED_API NPY_1_11_API_VERSION
 #include <numpy/arrayobject.h>
@@ -17,17 +22,26 @@ bool compare_observations(const observation& a, const observation& b) {
 }
 
 
-std::vector<double> inplace_phase_fold(std::vector<observation>& data, std::vector<double>& periods) {
+// Computes a period statistic of one light curve at each of nperiods periods
+typedef std::function<void(const std::vector<observation>&, const double*, size_t, double*)> fold_statistic;
+
+// Fills a buffer with the observations of one light curve of a batch
+typedef std::function<void(size_t, std::vector<observation>&)> curve_reader;
+
+
+void inplace_phase_fold(const std::vector<observation>& data, const double* periods, size_t nperiods,
+                        double* dispersion) {
     if (data.size() == 0) {
-        return std::vector<double>(periods.size());
+        std::fill(dispersion, dispersion + nperiods, 0.0);
+        return;
     }
-    auto dispersion = std::vector<double>();
-    dispersion.reserve(periods.size());
 
+    // Scratch buffers are per call, so calls on separate threads share nothing
     auto phased = std::vector<observation>(data.size());
     auto bounds = std::vector<std::vector<observation>::iterator>();
 
-    for (auto& period : periods) {
+    for (size_t p = 0; p < nperiods; p++) {
+        auto period = periods[p];
         bounds.clear();
 
         phased[0] = {fmod(data[0].time, period), data[0].flux};
@@ -49,55 +63,495 @@ std::vector<double> inplace_phase_fold(std::vector<observation>& data, std::vect
         for (auto i = 0; i < phased.size()-1; i++) {
             disp += fabs(phased[i].flux - phased[i + 1].flux);
         }
-        dispersion.push_back(disp);
+        dispersion[p] = disp;
     }
-    return dispersion;
 }
 
 
-static PyObject* phase_dispersion(PyObject* self, PyObject *args, PyObject* kwargs) {
-    PyArrayObject* timeArg = NULL;
-    PyArrayObject* fluxArg = NULL;
-    PyArrayObject* periodsArg = NULL;
-    static char* kwdlist[] = {"time", "flux", "periods", NULL};
+inline bool is_finite(const observation& point) {
+    return std::isfinite(point.time) && std::isfinite(point.flux);
+}
+
+
+inline size_t phase_bin(double time, double frequency, size_t nbins) {
+    // Cheaper than fmod, and already in [0, 1) for negative times
+    auto cycles = time * frequency;
+    return std::min(nbins - 1, (size_t)((cycles - floor(cycles)) * nbins));
+}
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!O!O!", kwdlist,
-                                     &PyArray_Type, &timeArg,
-                                     &PyArray_Type, &fluxArg,
-                                     &PyArray_Type, &periodsArg)) {
-        return NULL;
+
+void binned_dispersion(const std::vector<observation>& data, const double* periods, size_t nperiods,
+                       double* theta, size_t nbins) {
+    /* Stellingwerf's PDM theta: the pooled variance of the flux within
+     * phase bins over the total variance. Each period is one pass that
+     * accumulates per-bin sums, with no sort. Points with a non-finite
+     * time or flux are left out. */
+    size_t n = std::count_if(data.begin(), data.end(), is_finite);
+    if (n < 2) {
+        std::fill(theta, theta + nperiods, NAN);
+        return;
+    }
+
+    // Centering keeps the per-bin sums of squares from cancelling
+    auto mean = 0.0;
+    for (auto& point : data) {
+        if (is_finite(point)) {
+            mean += point.flux;
+        }
+    }
+    mean /= n;
+    auto total = 0.0;
+    for (auto& point : data) {
+        if (is_finite(point)) {
+            total += (point.flux - mean) * (point.flux - mean);
+        }
+    }
+    auto variance = total / (n - 1);
+
+    auto count = std::vector<size_t>(nbins);
+    auto sum = std::vector<double>(nbins);
+    auto sum_squares = std::vector<double>(nbins);
+    for (size_t p = 0; p < nperiods; p++) {
+        std::fill(count.begin(), count.end(), 0);
+        std::fill(sum.begin(), sum.end(), 0.0);
+        std::fill(sum_squares.begin(), sum_squares.end(), 0.0);
+        auto frequency = 1 / periods[p];
+        for (auto& point : data) {
+            if (!is_finite(point)) {
+                continue;
+            }
+            auto bin = phase_bin(point.time, frequency, nbins);
+            auto flux = point.flux - mean;
+            count[bin]++;
+            sum[bin] += flux;
+            sum_squares[bin] += flux * flux;
+        }
+
+        // Bins with fewer than two points say nothing about the scatter
+        auto within = 0.0;
+        size_t degrees = 0;
+        for (size_t b = 0; b < nbins; b++) {
+            if (count[b] > 1) {
+                within += sum_squares[b] - sum[b] * sum[b] / count[b];
+                degrees += count[b] - 1;
+            }
+        }
+        theta[p] = degrees > 0 && variance > 0 ? within / degrees / variance : NAN;
+    }
+}
+
+
+void binned_entropy(const std::vector<observation>& data, const double* periods, size_t nperiods,
+                    double* entropy, size_t phase_bins, size_t flux_bins) {
+    /* Graham et al.'s conditional entropy of the flux given the phase, from
+     * a 2-d histogram of phase and flux normalized to its range. Each period
+     * is one pass over the points plus one over the histogram, with no sort.
+     * Points with a non-finite time or flux are left out. */
+    size_t n = std::count_if(data.begin(), data.end(), is_finite);
+    if (n == 0) {
+        std::fill(entropy, entropy + nperiods, 0.0);
+        return;
+    }
+
+    // The flux bins do not depend on the period
+    double low = INFINITY, high = -INFINITY;
+    for (auto& point : data) {
+        if (is_finite(point)) {
+            low = std::min(low, point.flux);
+            high = std::max(high, point.flux);
+        }
+    }
+    auto row = std::vector<size_t>(data.size());
+    for (size_t i = 0; i < data.size(); i++) {
+        if (is_finite(data[i])) {
+            auto level = high > low ? (data[i].flux - low) / (high - low) : 0.0;
+            row[i] = std::min(flux_bins - 1, (size_t)(level * flux_bins));
+        }
     }
 
-    npy_intp* dims = PyArray_DIMS(timeArg);
-    auto timeData = (double*)PyArray_DATA(timeArg);
-    auto fluxData = (double*)PyArray_DATA(fluxArg);
+    auto histogram = std::vector<size_t>(phase_bins * flux_bins);
+    auto marginal = std::vector<size_t>(phase_bins);
+    for (size_t p = 0; p < nperiods; p++) {
+        std::fill(histogram.begin(), histogram.end(), 0);
+        std::fill(marginal.begin(), marginal.end(), 0);
+        auto frequency = 1 / periods[p];
+        for (size_t i = 0; i < data.size(); i++) {
+            if (!is_finite(data[i])) {
+                continue;
+            }
+            auto bin = phase_bin(data[i].time, frequency, phase_bins);
+            histogram[bin * flux_bins + row[i]]++;
+            marginal[bin]++;
+        }
 
+        auto h = 0.0;
+        for (size_t b = 0; b < phase_bins; b++) {
+            for (size_t f = 0; f < flux_bins; f++) {
+                auto joint = histogram[b * flux_bins + f];
+                if (joint > 0) {
+                    h += (double)joint / n * log((double)marginal[b] / joint);
+                }
+            }
+        }
+        entropy[p] = h;
+    }
+}
+
+
+int default_threads() {
+    auto threads = std::thread::hardware_concurrency();
+    return threads > 0 ? threads : 1;
+}
+
+
+// More threads than this only add overhead, and far more fail to start
+const int THREADS_PER_CORE = 4;
+
+
+void fold_range(const fold_statistic& statistic, const curve_reader& read, const double* periods, size_t nperiods,
+                double* dispersion, size_t start, size_t stop) {
+    /* Compute elements start to stop of the row-major (curves, periods)
+     * statistic array, one run of periods per curve. Each curve is read
+     * into one buffer reused for the whole range, so a thread only ever
+     * holds one curve. */
     auto data = std::vector<observation>();
-    data.reserve(dims[0]);
-    for (auto i = 0; i < dims[0]; i++) {
-        data.push_back({timeData[i], fluxData[i]});
+    while (start < stop) {
+        auto curve = start / nperiods;
+        auto first = start % nperiods;
+        auto last = std::min(nperiods, first + (stop - start));
+        read(curve, data);
+        statistic(data, periods + first, last - first, dispersion + start);
+        start += last - first;
+    }
+}
+
+
+std::exception_ptr parallel_phase_fold(const fold_statistic& statistic, const curve_reader& read, size_t ncurves,
+                                       const double* periods, size_t nperiods, double* dispersion, int nthreads) {
+    /* Split the (curve, period) pairs into one contiguous block per thread.
+     * Every pair's result only depends on its curve and period, so the
+     * output does not depend on the number of threads. Blocks whose thread
+     * cannot be started run on the calling thread. Nothing is thrown; the
+     * first exception of any block is returned, or null if all succeeded. */
+    size_t total = ncurves * nperiods;
+    if (total == 0) {
+        return nullptr;
+    }
+    nthreads = std::min(nthreads, THREADS_PER_CORE * default_threads());
+    size_t nblocks = std::max<size_t>(1, std::min<size_t>(nthreads, total));
+
+    auto errors = std::vector<std::exception_ptr>(nblocks);
+    auto run_block = [&](size_t b) {
+        try {
+            fold_range(statistic, read, periods, nperiods, dispersion, total * b / nblocks, total * (b + 1) / nblocks);
+        } catch (...) {
+            errors[b] = std::current_exception();
+        }
+    };
+
+    auto workers = std::vector<std::thread>();
+    size_t started = 1;
+    try {
+        workers.reserve(nblocks - 1);
+        for (; started < nblocks; started++) {
+            workers.emplace_back(run_block, started);
+        }
+    } catch (...) {
+        // std::system_error or std::bad_alloc; the threads already running are kept
+    }
+    run_block(0);
+    for (auto b = started; b < nblocks; b++) {
+        run_block(b);
+    }
+    for (auto& worker : workers) {
+        worker.join();
+    }
+
+    for (auto& error : errors) {
+        if (error) {
+            return error;
+        }
+    }
+    return nullptr;
+}
+
+
+static void set_python_error(std::exception_ptr error) {
+    /* Raise the exception of a failed fold as MemoryError or RuntimeError */
+    try {
+        std::rethrow_exception(error);
+    } catch (const std::bad_alloc&) {
+        PyErr_NoMemory();
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+    } catch (...) {
+        PyErr_SetString(PyExc_RuntimeError, "unknown error in phase folding threads");
+    }
+}
+
+
+// Owns a reference to an array and drops it when it goes out of scope
+struct ArrayRef {
+    PyArrayObject* array = NULL;
+    ~ArrayRef() { Py_XDECREF(array); }
+};
+
+
+static bool as_float_array(PyObject* object, const char* name, int min_dims, int max_dims, ArrayRef& ref) {
+    /* View object as a float32 or float64 array. Aligned native-order float
+     * arrays are used as they are whatever their strides; anything else is
+     * converted to float64. */
+    int type = NPY_DOUBLE;
+    if (PyArray_Check(object) && PyArray_TYPE((PyArrayObject*)object) == NPY_FLOAT) {
+        type = NPY_FLOAT;
+    }
+    ref.array = (PyArrayObject*)PyArray_FROMANY(object, type, 0, 0, NPY_ARRAY_ALIGNED | NPY_ARRAY_NOTSWAPPED);
+    if (ref.array == NULL) {
+        return false;
+    }
+    auto ndim = PyArray_NDIM(ref.array);
+    if (ndim < min_dims || ndim > max_dims) {
+        if (min_dims == max_dims) {
+            PyErr_Format(PyExc_ValueError, "%s must be %d-dimensional, not %d", name, min_dims, ndim);
+        } else {
+            PyErr_Format(PyExc_ValueError, "%s must be %d- to %d-dimensional, not %d", name, min_dims, max_dims, ndim);
+        }
+        return false;
     }
+    return true;
+}
+
 
-    dims = PyArray_DIMS(periodsArg);
-    auto periodsData = (double*)PyArray_DATA(periodsArg);
-    auto periods = std::vector<double>(periodsData, periodsData+dims[0]);
+static inline double element(PyArrayObject* array, const char* pointer) {
+    if (PyArray_TYPE(array) == NPY_FLOAT) {
+        return *(const float*)pointer;
+    }
+    return *(const double*)pointer;
+}
 
-    auto dispersion = inplace_phase_fold(data, periods);
 
-    PyObject* output = PyArray_SimpleNew(1, dims, NPY_DOUBLE);
-    auto output_data = (double*)PyArray_DATA((PyArrayObject*)output);
-    for (auto i = 0; i < dispersion.size(); i++) {
-        output_data[i] = dispersion[i];
+static void read_curve(PyArrayObject* time, PyArrayObject* flux, npy_intp row, std::vector<observation>& data) {
+    /* Gather row of a 1-d or 2-d flux array and the matching times, which
+     * are shared by every row when time is 1-d, into data. Only the array
+     * structs are read, not Python objects, so this runs without the GIL. */
+    auto npoints = PyArray_DIM(flux, PyArray_NDIM(flux) - 1);
+    auto time_data = PyArray_BYTES(time);
+    auto flux_data = PyArray_BYTES(flux);
+    if (PyArray_NDIM(time) == 2) {
+        time_data += row * PyArray_STRIDE(time, 0);
     }
+    if (PyArray_NDIM(flux) == 2) {
+        flux_data += row * PyArray_STRIDE(flux, 0);
+    }
+    auto time_stride = PyArray_STRIDE(time, PyArray_NDIM(time) - 1);
+    auto flux_stride = PyArray_STRIDE(flux, PyArray_NDIM(flux) - 1);
 
-    return output;
+    data.resize(npoints);
+    for (npy_intp i = 0; i < npoints; i++) {
+        data[i] = {element(time, time_data + i*time_stride), element(flux, flux_data + i*flux_stride)};
+    }
 }
 
 
+static PyObject* evaluate(const fold_statistic& statistic, bool batch, PyObject* timeArg, PyObject* fluxArg,
+                          PyObject* periodsArg, PyObject* outArg, int threads) {
+    /* Shared input handling of every statistic, for one curve or a batch */
+    if (threads <= 0) {
+        threads = default_threads();
+    }
+
+    ArrayRef time, flux, periods;
+    int flux_dims = batch ? 2 : 1;
+    if (!as_float_array(timeArg, "time", 1, flux_dims, time) ||
+        !as_float_array(fluxArg, "flux", flux_dims, flux_dims, flux)) {
+        return NULL;
+    }
+    npy_intp ncurves = batch ? PyArray_DIM(flux.array, 0) : 1;
+    npy_intp npoints = PyArray_DIM(flux.array, flux_dims - 1);
+    if (PyArray_DIM(time.array, PyArray_NDIM(time.array) - 1) != npoints ||
+        (PyArray_NDIM(time.array) == 2 && PyArray_DIM(time.array, 0) != ncurves)) {
+        PyErr_SetString(PyExc_ValueError, batch ?
+                        "time must have the shape of flux or of one of its rows" :
+                        "time and flux must have the same length");
+        return NULL;
+    }
+
+    // Periods are read many times by every thread, so they are made contiguous
+    periods.array = (PyArrayObject*)PyArray_FROMANY(periodsArg, NPY_DOUBLE, 1, 1, NPY_ARRAY_IN_ARRAY);
+    if (periods.array == NULL) {
+        return NULL;
+    }
+    npy_intp nperiods = PyArray_DIM(periods.array, 0);
+    auto periods_data = (const double*)PyArray_DATA(periods.array);
+    for (npy_intp i = 0; i < nperiods; i++) {
+        if (!(periods_data[i] > 0) || std::isinf(periods_data[i])) {
+            PyErr_SetString(PyExc_ValueError, "periods must be positive and finite");
+            return NULL;
+        }
+    }
+
+    npy_intp out_dims[] = {ncurves, nperiods};
+    npy_intp* shape = batch ? out_dims : out_dims + 1;
+    PyArrayObject* output;
+    if (outArg == Py_None) {
+        output = (PyArrayObject*)PyArray_SimpleNew(flux_dims, shape, NPY_DOUBLE);
+        if (output == NULL) {
+            return NULL;
+        }
+    } else {
+        if (!PyArray_Check(outArg)) {
+            PyErr_SetString(PyExc_TypeError, "out must be a numpy array");
+            return NULL;
+        }
+        output = (PyArrayObject*)outArg;
+        // The dims are only compared once there are as many as expected
+        if (PyArray_TYPE(output) != NPY_DOUBLE || !PyArray_ISCARRAY(output) || !PyArray_ISNOTSWAPPED(output) ||
+            PyArray_NDIM(output) != flux_dims || !PyArray_CompareLists(PyArray_DIMS(output), shape, flux_dims)) {
+            PyErr_SetString(PyExc_ValueError, batch ?
+                            "out must be a writeable C-contiguous float64 array of shape (curves, periods)" :
+                            "out must be a writeable C-contiguous float64 array of shape (periods,)");
+            return NULL;
+        }
+        Py_INCREF(output);
+    }
+
+    // Each thread gathers the curves it folds as it reaches them
+    auto read = [&time, &flux](size_t row, std::vector<observation>& data) {
+        read_curve(time.array, flux.array, row, data);
+    };
+
+    // Everything the threads touch is owned here, so Python can run meanwhile
+    auto output_data = (double*)PyArray_DATA(output);
+    std::exception_ptr error;
+    Py_BEGIN_ALLOW_THREADS
+    error = parallel_phase_fold(statistic, read, ncurves, periods_data, nperiods, output_data, threads);
+    Py_END_ALLOW_THREADS
+
+    if (error) {
+        Py_DECREF(output);
+        set_python_error(error);
+        return NULL;
+    }
+    return (PyObject*)output;
+}
+
+
+static PyObject* phase_dispersion(PyObject* self, PyObject *args, PyObject* kwargs, bool batch) {
+    PyObject* timeArg = NULL;
+    PyObject* fluxArg = NULL;
+    PyObject* periodsArg = NULL;
+    PyObject* outArg = Py_None;
+    int threads = 0;
+    static char* kwdlist[] = {"time", "flux", "periods", "out", "threads", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOO|Oi", kwdlist,
+                                     &timeArg, &fluxArg, &periodsArg, &outArg, &threads)) {
+        return NULL;
+    }
+    return evaluate(inplace_phase_fold, batch, timeArg, fluxArg, periodsArg, outArg, threads);
+}
+
+
+static PyObject* pdm_theta(PyObject* self, PyObject *args, PyObject* kwargs, bool batch) {
+    PyObject* timeArg = NULL;
+    PyObject* fluxArg = NULL;
+    PyObject* periodsArg = NULL;
+    PyObject* outArg = Py_None;
+    int threads = 0;
+    int bins = 10;
+    static char* kwdlist[] = {"time", "flux", "periods", "bins", "out", "threads", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOO|iOi", kwdlist,
+                                     &timeArg, &fluxArg, &periodsArg, &bins, &outArg, &threads)) {
+        return NULL;
+    }
+    if (bins < 1) {
+        PyErr_SetString(PyExc_ValueError, "bins must be positive");
+        return NULL;
+    }
+    auto statistic = [bins](const std::vector<observation>& data, const double* periods, size_t nperiods,
+                            double* theta) {
+        binned_dispersion(data, periods, nperiods, theta, bins);
+    };
+    return evaluate(statistic, batch, timeArg, fluxArg, periodsArg, outArg, threads);
+}
+
+
+static PyObject* conditional_entropy(PyObject* self, PyObject *args, PyObject* kwargs, bool batch) {
+    PyObject* timeArg = NULL;
+    PyObject* fluxArg = NULL;
+    PyObject* periodsArg = NULL;
+    PyObject* outArg = Py_None;
+    int threads = 0;
+    int phase_bins = 10;
+    int flux_bins = 10;
+    static char* kwdlist[] = {"time", "flux", "periods", "phase_bins", "flux_bins", "out", "threads", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOO|iiOi", kwdlist,
+                                     &timeArg, &fluxArg, &periodsArg, &phase_bins, &flux_bins, &outArg, &threads)) {
+        return NULL;
+    }
+    if (phase_bins < 1 || flux_bins < 1) {
+        PyErr_SetString(PyExc_ValueError, "phase_bins and flux_bins must be positive");
+        return NULL;
+    }
+    auto statistic = [phase_bins, flux_bins](const std::vector<observation>& data, const double* periods,
+                                             size_t nperiods, double* entropy) {
+        binned_entropy(data, periods, nperiods, entropy, phase_bins, flux_bins);
+    };
+    return evaluate(statistic, batch, timeArg, fluxArg, periodsArg, outArg, threads);
+}
+
+
+// Each statistic is exposed for one curve and for a batch of curves
+#define SINGLE_AND_BATCH(name) \
+    static PyObject* name##_single(PyObject* self, PyObject *args, PyObject* kwargs) { \
+        return name(self, args, kwargs, false); \
+    } \
+    static PyObject* name##_batch(PyObject* self, PyObject *args, PyObject* kwargs) { \
+        return name(self, args, kwargs, true); \
+    }
+
+SINGLE_AND_BATCH(phase_dispersion)
+SINGLE_AND_BATCH(pdm_theta)
+SINGLE_AND_BATCH(conditional_entropy)
+
 
 static PyMethodDef methods[] = {
-        {"phase_dispersion",  (PyCFunction)phase_dispersion, METH_VARARGS | METH_KEYWORDS,
-         "Compute the phase dispersion of time and flux data at given periods"},
+        {"phase_dispersion",  (PyCFunction)phase_dispersion_single, METH_VARARGS | METH_KEYWORDS,
+         "phase_dispersion(time, flux, periods, out=None, threads=0)\n\n"
+         "Compute the phase dispersion of time and flux data at given periods.\n"
+         "time and flux may be float32 or float64 with any strides; other input is\n"
+         "converted to float64. The result is written to out if it is given, which\n"
+         "must be a C-contiguous float64 array with one element per period.\n"
+         "The periods are split across the given number of native threads, by default\n"
+         "one per core and at most four per core, and the GIL is released while they run."},
+        {"phase_dispersion_batch",  (PyCFunction)phase_dispersion_batch, METH_VARARGS | METH_KEYWORDS,
+         "phase_dispersion_batch(time, flux, periods, out=None, threads=0)\n\n"
+         "Compute the phase dispersion of many light curves at the same periods.\n"
+         "flux is a (curves, points) array and time is either the same shape or a\n"
+         "single row shared by every curve. Returns a (curves, periods) array and\n"
+         "otherwise behaves like phase_dispersion."},
+        {"pdm_theta",  (PyCFunction)pdm_theta_single, METH_VARARGS | METH_KEYWORDS,
+         "pdm_theta(time, flux, periods, bins=10, out=None, threads=0)\n\n"
+         "Compute Stellingwerf's phase dispersion minimization statistic theta, the\n"
+         "pooled variance of the flux within equal phase bins over its total variance,\n"
+         "at given periods. Values well below 1 mark likely periods. Each period costs\n"
+         "one pass over the data with no sort. Points with a NaN or infinite time or\n"
+         "flux are ignored. Takes input like phase_dispersion."},
+        {"pdm_theta_batch",  (PyCFunction)pdm_theta_batch, METH_VARARGS | METH_KEYWORDS,
+         "pdm_theta_batch(time, flux, periods, bins=10, out=None, threads=0)\n\n"
+         "pdm_theta of many light curves, taking input like phase_dispersion_batch."},
+        {"conditional_entropy",  (PyCFunction)conditional_entropy_single, METH_VARARGS | METH_KEYWORDS,
+         "conditional_entropy(time, flux, periods, phase_bins=10, flux_bins=10, out=None, threads=0)\n\n"
+         "Compute the conditional entropy of the flux given the phase from a 2-d\n"
+         "histogram of phase and range-normalized flux at given periods. Lower values\n"
+         "mark likely periods. Each period costs one pass over the data with no sort.\n"
+         "Points with a NaN or infinite time or flux are ignored. Takes input like\n"
+         "phase_dispersion."},
+        {"conditional_entropy_batch",  (PyCFunction)conditional_entropy_batch, METH_VARARGS | METH_KEYWORDS,
+         "conditional_entropy_batch(time, flux, periods, phase_bins=10, flux_bins=10, out=None, threads=0)\n\n"
+         "conditional_entropy of many light curves, taking input like phase_dispersion_batch."},
         {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -1,162 +1,365 @@
 #!/usr/bin/env python
 
+import os
+import json
+
 import numpy as np
 from astropy.io import fits
-import scipy.ndimage
-import scipy.fftpack
-import scipy.optimize
+
+from align import Aligner
+import detection
 
 
-def getcentroid(coordinates, values):
+def detrend(flux, centroid, regressors=()):
     """
-    Image centroid from image points im that match with a 2-d array pos, which
-    contains the locations of each point in an all-positive coordinate system.
+    Detrend flux against centroid points, and optionally other regressors
+    such as airmass, temperature or FWHM. Returns normalized flux.
+
+    Each star's flux is fit with a linear model in its centroid and the
+    regressors plus a constant. Every star is solved at once from stacked
+    normal equations instead of one curve_fit call per star. Frames with a
+    NaN flux or regressor are left out of the fit.
+
+    Arguments:
+    flux -- (stars, frames) array, which is normalized in place
+    centroid -- (stars, frames, 2) array
+    regressors -- Arrays that broadcast to the shape of flux, so (frames,)
+    for one value per frame or (stars, frames) for one per star and frame
     """
-    return np.sum(values*coordinates, axis=1) / np.sum(values)
+    columns = [centroid[..., 0], centroid[..., 1]] + [np.broadcast_to(r, flux.shape) for r in regressors]
+    design = np.stack(columns, axis=-1)
+    good = np.isfinite(flux) & np.all(np.isfinite(design), axis=-1)
+
+    # Centering each regressor keeps the normal equations well conditioned
+    # when centroids vary by a fraction of a pixel around hundreds of pixels
+    count = good.sum(axis=1)[:, None]
+    design = design - (np.where(good[..., None], design, 0).sum(axis=1) / count)[:, None, :]
+    design = np.concatenate((design, np.ones(flux.shape + (1,))), axis=-1)
+
+    weighted = np.where(good[..., None], design, 0)
+    normal = np.swapaxes(weighted, 1, 2) @ weighted
+    projected = np.swapaxes(weighted, 1, 2) @ np.where(good, flux, 0)[..., None]
+    # pinv rather than solve so that a star with a degenerate fit, such as a
+    # constant centroid, cannot stop the whole batch
+    params = np.linalg.pinv(normal) @ projected
+
+    flux /= (design @ params)[..., 0]
+    flux /= np.nanmedian(flux, axis=1, keepdims=True)
+    return flux
+
 
+PHOTOMETRY_DTYPE = np.dtype([('y', float), ('x', float), ('flux', float), ('flux_err', float), ('sky', float)])
 
-def flatfunc(centroid, p0, p1, p2):
+
+class AperturePhotometry:
     """
-    Intended only for use with detrend().
+    Aperture photometry of every star in a frame at once.
+
+    The pixel offsets of a square stamp around a star, and the fraction of
+    each stamp pixel inside the aperture for a grid of subpixel star
+    positions, are computed once. Measuring a frame is then a gather of all
+    the stamps into one (stars, pixels) array and a few reductions over it,
+    so the cost scales with the number of stamp pixels rather than with
+    Python loops over stars.
     """
-    return p0*centroid[:, 0] + p1*centroid[:, 1] + p2
+    def __init__(self, radius, sky_inner=None, sky_outer=None, subsample=5, steps=10, gain=1.):
+        """
+        Arguments:
+        radius -- Aperture radius in pixels
+        sky_inner, sky_outer -- Radii of the sky annulus. If sky_outer is
+        None, the sky is the median of the whole frame instead.
+        subsample -- Each pixel is split into subsample**2 points to find
+        the fraction of it inside the aperture
+        steps -- Aperture weights are tabulated at this many subpixel
+        positions per pixel along each axis
+        gain -- Electrons per count, for the flux errors
+        """
+        self.radius = radius
+        self.sky_inner = radius if sky_inner is None else sky_inner
+        self.sky_outer = sky_outer
+        self.steps = steps
+        self.gain = gain
+
+        self.half = int(np.ceil(radius if sky_outer is None else max(radius, sky_outer))) + 1
+        dy, dx = np.mgrid[-self.half:self.half+1, -self.half:self.half+1]
+        self.dy, self.dx = dy.ravel(), dx.ravel()
+
+        # weights[i, j, k] is the fraction of stamp pixel k inside the aperture
+        # of a star offset by fractions[i], fractions[j] from the stamp center
+        # axes are (star y offset, star x offset, stamp pixel, point y, point x)
+        fractions = np.linspace(-0.5, 0.5, steps+1)
+        points = (np.arange(subsample) + 0.5) / subsample - 0.5
+        y = self.dy[:, None, None] + points[:, None] - fractions.reshape(-1, 1, 1, 1, 1)
+        x = self.dx[:, None, None] + points - fractions.reshape(1, -1, 1, 1, 1)
+        self.weights = np.mean(y**2 + x**2 <= radius**2, axis=(-2, -1))
+
+    def stamps(self, image, positions):
+        """Gather the stamp around each star.
+
+        Returns the (stars, pixels) stamp values, the integer stamp centers,
+        the stars' offsets from those centers and a mask of the stars whose
+        stamps lie entirely inside the image. Stamps of the other stars hold
+        clipped, meaningless pixels.
+        """
+        center = np.rint(positions).astype(int)
+        offset = positions - center
+        valid = np.all((center >= self.half) & (center < np.array(image.shape) - self.half), axis=1)
+
+        rows = np.clip(center[:, 0, None] + self.dy, 0, image.shape[0]-1)
+        cols = np.clip(center[:, 1, None] + self.dx, 0, image.shape[1]-1)
+        return image[rows, cols], center, offset, valid
+
+    def frame_sky(self, image):
+        """The median and standard deviation of a whole frame, which is the
+        sky of every star when there is no annulus. It costs a pass over the
+        frame, so compute it once per frame and pass it to centroids and
+        measure."""
+        level = np.median(image)
+        return level, 1.4826 * np.median(np.abs(image - level))
 
+    def sky(self, image, pixels, offset, frame_sky=None):
+        """The median and standard deviation of the sky around each star,
+        and the number of pixels they were measured from. Without an
+        annulus this is frame_sky, computed here if it is not given."""
+        if self.sky_outer is None:
+            level, spread = self.frame_sky(image) if frame_sky is None else frame_sky
+            return np.full(len(pixels), level), np.full(len(pixels), spread), np.full(len(pixels), image.size)
 
-def detrend(flux,centroid):
+        distance = (self.dy - offset[:, 0, None])**2 + (self.dx - offset[:, 1, None])**2
+        annulus = (distance >= self.sky_inner**2) & (distance <= self.sky_outer**2)
+        count = annulus.sum(axis=1)
+
+        # Sorting puts the NaNs outside the annulus last, so the median of
+        # each row sits in the middle of its first count values
+        values = np.sort(np.where(annulus, pixels, np.nan), axis=1)
+        lower = np.take_along_axis(values, ((count - 1) // 2)[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(values, (count // 2)[:, None], axis=1)[:, 0]
+        spread = np.sqrt(np.sum(np.where(annulus, pixels - ((lower + upper) / 2)[:, None], 0)**2, axis=1) / count)
+        return (lower + upper) / 2, spread, count
+
+    def centroids(self, image, positions, iterations=2, frame_sky=None):
+        """Refine star positions to the sky-subtracted intensity-weighted
+        centroid inside the aperture. Stars whose stamps leave the image
+        keep their positions. frame_sky is as returned by frame_sky for
+        this image."""
+        positions = np.array(positions, dtype=float)
+        aperture = self.dy**2 + self.dx**2 <= self.radius**2
+        if self.sky_outer is None and frame_sky is None:
+            frame_sky = self.frame_sky(image)
+        for _ in range(iterations):
+            pixels, center, offset, valid = self.stamps(image, positions)
+            level, _, _ = self.sky(image, pixels, offset, frame_sky)
+            weight = np.clip(pixels - level[:, None], 0, None) * aperture
+            total = weight.sum(axis=1)
+            valid &= total > 0
+            total[~valid] = 1
+            refined = center + np.column_stack((weight @ self.dy, weight @ self.dx)) / total[:, None]
+            positions[valid] = refined[valid]
+        return positions
+
+    def measure(self, image, positions, frame_sky=None):
+        """Measure every star at the given positions.
+
+        Returns an array of PHOTOMETRY_DTYPE with the sky-subtracted flux in
+        the aperture, its error from photon and sky noise, and the sky level
+        per pixel. Stars whose stamps leave the image are NaN. frame_sky is
+        as returned by frame_sky for this image.
+        """
+        positions = np.asarray(positions, dtype=float)
+        pixels, center, offset, valid = self.stamps(image, positions)
+        level, spread, count = self.sky(image, pixels, offset, frame_sky)
+
+        index = np.rint((offset + 0.5) * self.steps).astype(int)
+        weights = self.weights[index[:, 0], index[:, 1]]
+        area = weights.sum(axis=1)
+
+        result = np.empty(len(positions), PHOTOMETRY_DTYPE)
+        result['y'], result['x'] = positions.T
+        result['flux'] = np.sum(weights * pixels, axis=1) - level * area
+        result['flux_err'] = np.sqrt(np.clip(result['flux'], 0, None) / self.gain
+                                     + area * spread**2 * (1 + area / count))
+        result['sky'] = level
+        result[~valid] = (np.nan,) * len(PHOTOMETRY_DTYPE.names)
+        result['y'][~valid], result['x'][~valid] = positions[~valid].T
+        return result
+
+
+class LightCurveStore:
     """
-    Detrend flux against centroid points. Returns normalized flux.
+    An appendable on-disk column store of per-frame photometry.
+
+    The store is a directory holding one raw little-endian float64 file per
+    column, each growing by one row per frame, and a metadata.json with the
+    number of stars. A frame only counts once every column holds its row,
+    so after a crash the store reopens at the last completed frame and the
+    partial row is dropped. Columns are read back as memory maps shaped
+    (frames,) + the column's row shape, so whole nights of light curves can
+    be used without loading them.
     """
-    for f in range(flux.shape[0]):
-        p, cov = scipy.optimize.curve_fit(flatfunc, centroid[f], flux[f])
-        flux[f] /= flatfunc(centroid[f], *p)
-        flux[f] /= np.median(flux[f])
-    return flux
+    # Values per star in each column's rows, or None for one value per frame
+    COLUMNS = {'time': None, 'flux': 1, 'flux_err': 1, 'centroid': 2, 'sky': 1}
+    DTYPE = np.dtype('<f8')
+
+    def __init__(self, path, nstars=None):
+        """
+        Open the store at path, creating it for nstars stars if it does not
+        exist yet.
+        """
+        self.path = path
+        metadata_path = os.path.join(path, 'metadata.json')
+        if os.path.isfile(metadata_path):
+            with open(metadata_path) as f:
+                self.nstars = json.load(f)['nstars']
+            if nstars is not None and nstars != self.nstars:
+                raise ValueError('{} holds {} stars, not {}'.format(path, self.nstars, nstars))
+        else:
+            if nstars is None:
+                raise ValueError('nstars is needed to create a new store at {}'.format(path))
+            os.makedirs(path, exist_ok=True)
+            self.nstars = nstars
+            with open(metadata_path, 'w') as f:
+                json.dump({'nstars': nstars, 'columns': list(self.COLUMNS)}, f)
+
+        self.nframes = min(os.path.getsize(self.column_path(name)) // self.row_bytes(name)
+                           if os.path.isfile(self.column_path(name)) else 0 for name in self.COLUMNS)
+        self.files = dict()
+        for name in self.COLUMNS:
+            f = open(self.column_path(name), 'ab')
+            f.truncate(self.nframes * self.row_bytes(name))
+            self.files[name] = f
+
+    def column_path(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def row_shape(self, name):
+        per_star = self.COLUMNS[name]
+        if per_star is None:
+            return ()
+        if per_star == 1:
+            return (self.nstars,)
+        return (self.nstars, per_star)
+
+    def row_bytes(self, name):
+        return int(np.prod(self.row_shape(name))) * self.DTYPE.itemsize
+
+    def __len__(self):
+        return self.nframes
+
+    def append(self, time, result):
+        """Add one frame's photometry
 
+        Arguments:
+        time -- The time of the frame
+        result -- The frame's measurements as returned by AperturePhotometry.measure
+        """
+        rows = {
+            'time': time,
+            'flux': result['flux'],
+            'flux_err': result['flux_err'],
+            'centroid': np.column_stack((result['y'], result['x'])),
+            'sky': result['sky'],
+        }
+        for name, row in rows.items():
+            self.files[name].write(np.asarray(row, dtype=self.DTYPE).reshape(self.row_shape(name)).tobytes())
+            self.files[name].flush()
+        self.nframes += 1
 
-def photometer(files, coords, obj, sky=None):
+    def column(self, name):
+        """Memory-map a column with shape (frames,) + its row shape"""
+        shape = (self.nframes,) + self.row_shape(name)
+        if self.nframes == 0:
+            return np.empty(shape, self.DTYPE)
+        return np.memmap(self.column_path(name), dtype=self.DTYPE, mode='r', shape=shape)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def photometer(files, coords, obj, sky=None, output=None, time_keyword='JD', track=False):
     """
     Aperture photometery on images contained in files at initial star positions
     near coords. Returns flux of each star with corresponding centroid locations.
+
+    Arguments:
+    obj -- The aperture radius
+    sky -- The outer radius of a sky annulus that starts at the aperture. If
+    None, the sky is the median of each image.
+    output -- The path of a LightCurveStore to stream each frame's results
+    into. If the store already holds frames, the run resumes after them from
+    the last measured positions, and the returned arrays are memory maps of
+    the store.
+    time_keyword -- The header keyword holding each frame's time for the store
+    track -- Instead of following each star from its previous centroid,
+    solve for one offset per frame by phase correlation with the first
+    frame (where coords must be correct) and refine every star from coords
+    moved by that offset. Tracking then survives translations of the whole
+    field, such as guiding glitches, of up to half the frame. It does not
+    follow rotations such as a meridian flip.
     """
-    centroid = np.zeros((coords.shape[0],len(files),2))
-    flux = np.zeros((coords.shape[0],len(files)))
-    
-    centroid[:,-1] = coords
-    
-    if sky == None:
-        sky = obj
-    has_sky = sky != None
-    
-    pos = np.mgrid[-sky:sky+1,-sky:sky+1]
-    dst = np.sqrt(np.sum(pos,0))
-    
-    objap = dst <= obj
-    skyap = dst <= sky
-    
-    objsize = np.sum(objap)
-    
-    for f in range(len(files)):
-        im = fits.open(files[f])[0].data
-        
-        if not has_sky:
-            skyval = np.median(im)*objsize
-        
-        for c in range(coords.shape[0]):
-            #Could start new subprocess here
-            y,x = centroid[c,f-1]
-            
-            if y > 0 and x > 0 and y < im.shape[0] and x < im.shape[1]:
-                
-                y,x = seekmax(im,y,x)
-                
-                y,x = getcentroid(*getstar(im,y,x))
-
-            if y > sky and x > sky and y < im.shape[0]-sky-1 and x < im.shape[1]-sky-1:
-                
-                if has_sky:
-                    skyval = np.median(im[y-sky:y+sky+1,x-sky:x+sky+1][skyap]) * objsize
-                
-                flux[c,f] = np.sum(im[y-sky:y+sky+1,x-sky:x+sky+1][objap]) - skyval
-                
-                centroid[c,f] = y,x
+    engine = AperturePhotometry(obj, sky_outer=sky)
+    positions = np.asarray(coords, dtype=float)
+    if track:
+        aligner = Aligner(fits.getdata(files[0]).astype(float), engine='fft')
+
+    if output is None:
+        store = None
+        start = 0
+        centroid = np.zeros((coords.shape[0],len(files),2))
+        flux = np.zeros((coords.shape[0],len(files)))
+    else:
+        store = LightCurveStore(output, coords.shape[0])
+        start = len(store)
+        if start > 0:
+            positions = np.array(store.column('centroid')[-1])
+
+    for f in range(start, len(files)):
+        im, header = fits.getdata(files[f], header=True)
+        im = im.astype(float)
+
+        # Without an annulus the sky is the whole frame's, found once here
+        frame_sky = engine.frame_sky(im) if sky is None else None
+        if track:
+            # The template's features sit at the image's plus this offset
+            positions = engine.centroids(im, coords - np.array(aligner.offset(im)), frame_sky=frame_sky)
+        else:
+            positions = engine.centroids(im, positions, frame_sky=frame_sky)
+        result = engine.measure(im, positions, frame_sky)
+
+        if store is None:
+            flux[:,f] = result['flux']
+            centroid[:,f] = positions
+        else:
+            store.append(header.get(time_keyword, np.nan), result)
+
+    if store is not None:
+        store.close()
+        flux = store.column('flux').T
+        centroid = store.column('centroid').transpose(1, 0, 2)
     
     return flux,centroid
 
 
-def find_stars(data):
-    #If passed a list, stack and median-combine first
-    if isinstance(data,list):
-        warps,aligned = astt.align(data)
-        aligned = np.asarray(aligned)
-        im = np.median(aligned,0)
+def find_stars(data, **options):
+    """
+    Find the stars in an image with detection.find_stars. If passed a list
+    of images, they are aligned to the first and median-combined first.
+    Keyword arguments are passed on to detection.find_stars.
+    """
+    if isinstance(data, list):
+        aligned = [image for _, image in Aligner(data[0], engine='fft').align_many(data)]
+        image = np.median(aligned, axis=0)
     else:
-        im = data
-    
-    
-    #Denoise the image with a fourier filter
-    fourier = np.fft.fft2(im)
-    fourier = np.fft.fftshift(fourier)
-    print(fourier.max())
-    fits.writeto('fourier.fits',abs(fourier),clobber=True)
-    exit()
-    
-    #Compute the second derivative at every point
-    laplace = ndimage.laplace(smoothed)
-    
-    #Image should be concave down where there are stars
-    stars = derivative < 0
-    
-    #Stars should also be a local min in the laplacian
-    row_buffer = np.zeros(laplace.shape[0])
-    col_buffer = row_buffer[None,:]
-    above = np.vstack((laplace[1:],row_buffer[:]))
-    below = np.vstack((row_buffer[:,:],laplace[:-1]))
-    right = np.hstack((laplace[1:],row_buffer[:,:]))
-
-    stars = stars & (laplace < above) & (laplace < below) & (laplace < right)
-    
-    #Denoise the image with a fourier filter
-    print(np.std(im))
-    fourier = scipy.fftpack.rfft(im)
-    fits.writeto('fft.fits',fourier,clobber=True)
-    fourier[0] = 0
-    fourier[-1] = 0
-    fourier[:,0] = 0
-    fourier[:,-1] = 0
-    test = scipy.fftpack.ifft(fourier).real
-    fits.writeto('ifft.fits',test,clobber=True)
-    print(np.std(test))
-    exit()
-    
-    #Compute the second derivative at every point
-    laplace = ndimage.laplace(smoothed)
-    
-    #Image should be concave down where there are stars
-    stars = derivative < 0
-    
-    #Stars should also be a local min in the laplacian
-    row_buffer = np.zeros(laplace.shape[0])
-    col_buffer = np.zeros(laplace.shape[1][None,:])
-    above = np.vstack((laplace[1:],row_buffer[:]))
-    below = np.vstack((row_buffer[:,:],laplace[:-1]))
-    right = np.hstack((laplace[1:],row_buffer[:,:]))
+        image = data
 
-    stars = stars & (laplace < above) & (laplace < below) & (laplace < right) & (laplace < left)
+    return detection.find_stars(image, **options)
 
-    #Pick a sky value
-    sky = np.median(im)
-
-    #Sigma threshold for sky level
-    signal = im > (sky + sky_sigma*np.sqrt(sky))
-    
-    #Use binary erosion and propagation to remove isolated points of signal
-    eroded_signal = binary_erosion(signal)
-    signal = binary_propagation(eroded_signal,mask=signal)
-    
-    #Stars are only where signal is significant
-    stars = stars & signal
-    
-    return stars
 
 """
 image = fits.open('test.fits')[0].data
@@ -3,10 +3,9 @@
 import os
 import numpy as np
 from astropy.io import fits
-import scipy.optimize
-import scipy.signal
-from scipy.misc import imsave
-import scipy.ndimage
+
+from detection import find_stars
+from catalog import write_catalog
 
 
 def gaussian(coordinates, height, *centroid_and_width):
@@ -20,16 +19,202 @@ def gaussian(coordinates, height, *centroid_and_width):
     width = centroid_and_width[-1]
     centroids = centroid_and_width[:-1]
     
-    pos = coordinates.reshape((len(centroids),-1)).copy()
+    pos = coordinates.reshape((len(centroids),-1))
     
+    dst = 0
     for i in range(len(centroids)):
-        pos[i] -= centroids[i]
-     
-    dst = np.sum(pos**2,0)
+        dst = dst + (pos[i] - centroids[i])**2
     
     return height*np.exp(-dst/(2*width**2))
 
 
+PSF_DTYPE = np.dtype([(name, np.float64) for name in
+                      ('height', 'y', 'x', 'width', 'sky',
+                       'height_err', 'y_err', 'x_err', 'width_err', 'sky_err', 'chi2')])
+
+
+def psf_jacobian(params, size):
+    """
+    The Gaussian PSF plus sky and its Jacobian for a batch of stars on
+    size x size postage stamps.
+
+    Arguments:
+    params -- (n, 5) array of height, y, x, width and sky, with y and x in
+    pixels from the corner of each stamp
+    size -- Side of the stamps in pixels
+
+    Returns the (n, size*size) model and the (n, size*size, 5) derivatives
+    of the model with respect to each parameter.
+    """
+    coordinate = np.arange(size, dtype=np.float64)
+    height, y, x, width, sky = (params[:, i, None, None] for i in range(5))
+
+    dy = coordinate[None, :, None] - y
+    dx = coordinate[None, None, :] - x
+    dst = dy**2 + dx**2
+    profile = np.exp(-dst / (2*width**2))
+    peak = height * profile
+
+    jacobian = np.empty(peak.shape + (5,))
+    jacobian[..., 0] = profile
+    jacobian[..., 1] = peak * dy / width**2
+    jacobian[..., 2] = peak * dx / width**2
+    jacobian[..., 3] = peak * dst / width**3
+    jacobian[..., 4] = 1.
+
+    n = params.shape[0]
+    return (peak + sky).reshape(n, size*size), jacobian.reshape(n, size*size, 5)
+
+
+def fit_psf(stamps, guesses, iterations=50, tolerance=1e-8):
+    """
+    Fit a Gaussian PSF plus a flat sky to many equal-size postage stamps at
+    once with Levenberg-Marquardt.
+
+    Every star takes its own steps with its own damping, but the model,
+    Jacobian and normal equations of all the stars still being fit are
+    computed together in one batch. A star stops when a step changes its
+    chi-squared by less than tolerance of its value.
+
+    Arguments:
+    stamps -- (n, size, size) array of postage stamps
+    guesses -- (n, 5) array of starting height, y, x, width and sky, with y
+    and x in pixels from the corner of each stamp
+
+    Keyword arguments:
+    iterations -- The most steps to take
+    tolerance -- Relative change in chi-squared that ends a fit
+
+    Returns a PSF_DTYPE array of the fit parameters, their standard errors
+    scaled by the reduced chi-squared, and the chi-squared. Positions are
+    in stamp coordinates.
+    """
+    n, size = stamps.shape[0], stamps.shape[1]
+    data = stamps.reshape(n, size*size).astype(np.float64)
+    params = np.array(guesses, dtype=np.float64)
+
+    model, jacobian = psf_jacobian(params, size)
+    residual = data - model
+    chi2 = np.sum(residual**2, axis=1)
+    damping = np.full(n, 1e-3)
+    active = np.ones(n, dtype=bool)
+
+    for _ in range(iterations):
+        fitting = np.flatnonzero(active)
+        if not fitting.size:
+            break
+
+        transposed = jacobian[fitting].transpose(0, 2, 1)
+        alpha = transposed @ jacobian[fitting]
+        beta = transposed @ residual[fitting, :, None]
+        diagonal = np.arange(5)
+        alpha[:, diagonal, diagonal] *= 1 + damping[fitting, None]
+        step = (np.linalg.pinv(alpha) @ beta)[:, :, 0]
+
+        trial = params[fitting] + step
+        trial_model, trial_jacobian = psf_jacobian(trial, size)
+        trial_residual = data[fitting] - trial_model
+        trial_chi2 = np.sum(trial_residual**2, axis=1)
+
+        better = trial_chi2 < chi2[fitting]
+        converged = np.abs(chi2[fitting] - trial_chi2) <= tolerance * chi2[fitting]
+        accepted = fitting[better]
+        params[accepted] = trial[better]
+        jacobian[accepted] = trial_jacobian[better]
+        residual[accepted] = trial_residual[better]
+        chi2[accepted] = trial_chi2[better]
+
+        damping[fitting] = np.where(better, damping[fitting] / 10, damping[fitting] * 10)
+        active[fitting[converged]] = False
+        # A star whose steps keep failing is already at its minimum
+        active[damping > 1e10] = False
+
+    alpha = jacobian.transpose(0, 2, 1) @ jacobian
+    covariance = np.linalg.pinv(alpha) * (chi2 / (data.shape[1] - 5))[:, None, None]
+    errors = np.sqrt(np.abs(np.diagonal(covariance, axis1=1, axis2=2)))
+
+    fit = np.empty(n, dtype=PSF_DTYPE)
+    for i, name in enumerate(('height', 'y', 'x', 'width', 'sky')):
+        fit[name] = params[:, i]
+        fit[name + '_err'] = errors[:, i]
+    fit['width'] = np.abs(fit['width'])
+    fit['chi2'] = chi2
+    return fit
+
+
+def postage_stamps(image, y, x, radius):
+    """
+    Cut (2*radius+1)-pixel square stamps centered on the nearest pixel to
+    each (y, x) out of an image. Returns the stamps, their corners and a
+    mask of the stars whose stamps fit inside the image; only those stars
+    get stamps.
+    """
+    row = np.round(np.asarray(y)).astype(np.int64) - radius
+    col = np.round(np.asarray(x)).astype(np.int64) - radius
+    size = 2*radius + 1
+    inside = (row >= 0) & (col >= 0) & (row + size <= image.shape[0]) & (col + size <= image.shape[1])
+    row, col = row[inside], col[inside]
+
+    offsets = np.arange(size)
+    stamps = image[(row[:, None] + offsets)[:, :, None], (col[:, None] + offsets)[:, None, :]]
+    return stamps, np.column_stack((row, col)), inside
+
+
+def fit_stars(image, y, x, radius, width=1.5, **options):
+    """
+    Fit a Gaussian PSF to each star in an image with fit_psf.
+
+    Arguments:
+    image -- The image the stars are in
+    y, x -- Approximate positions of the stars
+    radius -- Half the side of the square fit around each star
+    width -- Starting standard deviation of the PSF in pixels
+
+    Keyword arguments are passed on to fit_psf. Returns a PSF_DTYPE array
+    in image coordinates with a row for every star. Stars too close to the
+    edge for a whole stamp are all NaN.
+    """
+    stamps, corners, inside = postage_stamps(image, y, x, radius)
+
+    # Start from the central pixel above the median of the stamp's border
+    border = np.concatenate((stamps[:, 0], stamps[:, -1], stamps[:, 1:-1, 0], stamps[:, 1:-1, -1]), axis=1)
+    sky = np.median(border, axis=1)
+    guesses = np.empty((stamps.shape[0], 5))
+    guesses[:, 0] = stamps[:, radius, radius] - sky
+    guesses[:, 1] = guesses[:, 2] = radius
+    guesses[:, 3] = width
+    guesses[:, 4] = sky
+
+    fit = np.full(inside.size, np.nan, dtype=PSF_DTYPE)
+    fit[inside] = fit_psf(stamps, guesses, **options)
+    fit['y'][inside] += corners[:, 0]
+    fit['x'][inside] += corners[:, 1]
+    return fit
+
+
+def render_stars(shape, fit, radius):
+    """
+    An image of the given shape holding the fitted PSFs, without the sky,
+    of every star in a PSF_DTYPE array out to radius pixels from its
+    center. Stars with NaN parameters are left out.
+    """
+    fit = fit[np.isfinite(fit['y']) & np.isfinite(fit['x'])]
+    params = np.column_stack([fit[name] for name in ('height', 'y', 'x', 'width')] + [np.zeros(fit.size)])
+    corners = np.round(params[:, 1:3]).astype(np.int64) - radius
+    size = 2*radius + 1
+    params[:, 1:3] -= corners
+    model, _ = psf_jacobian(params, size)
+
+    rows = (corners[:, 0, None] + np.arange(size))[:, :, None]
+    cols = (corners[:, 1, None] + np.arange(size))[:, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+
+    output = np.zeros(shape)
+    np.add.at(output, (rows[inside], cols[inside]), model.reshape(rows.shape)[inside])
+    return output
+
+
 def genfiles(path, file_extension='fits'):
     """Produce a generator that yields files ending with file_extension in directory path"""
     for entry in os.scandir(path):
@@ -44,56 +229,21 @@ if __name__ == "__main__":
     FILTER_WIDTH = 1.5
     APERTURE_RADIUS = 5
 
-    files = genfiles(INPUT_DIR)
+    files = sorted(genfiles(INPUT_DIR))
 
     # Open up the first file to figure out how big the images are so we can know the shape of the array to allocate
     image = fits.open(files[0])[0].data
     stack = np.empty((len(files),)+image.shape)
     stack[0] = image.copy()
 
-    for f, fname in enumerate(files[1:]):
+    for f, fname in enumerate(files[1:], 1):
         stack[f] = fits.open(fname)[0].data
 
     stacked = np.median(stack, axis=0, overwrite_input=True)
 
-    smooth = scipy.ndimage.gaussian_filter(stacked, FILTER_WIDTH)
-
-    laplace = scipy.ndimage.laplace(smooth)
-
-    stars = laplace < 0
-
-    stars_inds = scipy.signal.argrelmin(laplace)
-    stars = np.zeros(stacked.shape, bool)
-    stars[stars_inds] = True
-
-    sky_value = np.median(stacked)
-    signal = stacked > (sky_value + 2*np.sqrt(sky_value))
-
-    stars &= signal
-
-    coordinates = np.mgrid[:stacked.shape[0], :stacked.shape[1]]
-
-    coord = np.mgrid[:2*APERTURE_RADIUS+1, :2*APERTURE_RADIUS+1]
-    dst = np.sum(coord**2,0)
-    ap = dst <= APERTURE_RADIUS**2
-
-    star_coordinates = np.where(stars)
-
-    star_vectors = np.empty((star_coordinates.shape[0], ))
-    output_test = np.zeros(stacked.shape)
-
-    for i, (y, x) in enumerate(star_coordinates):
-        star_coordinates = coordinates[y-APERTURE_RADIUS:y+APERTURE_RADIUS+1,
-                                       x-APERTURE_RADIUS:x+APERTURE_RADIUS+1][ap]
-        star_data = stacked[y-APERTURE_RADIUS:x+APERTURE_RADIUS+1][ap]
-
-        guesses = [stacked[y, x]-sky_value, y, x, 1., sky_value]
-        fit, _ = scipy.optimize.curve_fit(gaussian, star_coordinates, star_data, p0=guesses)
-        
-        star_vectors[i] = fit
-
-        output_test[y-APERTURE_RADIUS:y+APERTURE_RADIUS+1,
-                    x-APERTURE_RADIUS:x+APERTURE_RADIUS+1][ap] += gaussian(star_coordinates, *fit)
+    stars = find_stars(stacked, FILTER_WIDTH)
+    star_vectors = fit_stars(stacked, stars['y'], stars['x'], APERTURE_RADIUS, FILTER_WIDTH)
+    output_test = render_stars(stacked.shape, star_vectors, APERTURE_RADIUS)
 
-    np.save('vectorized.npy',star_vectors)
-    imsave('vectorized.png',np.log(output_test))
+    write_catalog(os.path.join(OUTPUT_DIR, 'vectorized.fits'), star_vectors, INPUT_DIR, stacked.shape)
+    fits.writeto(os.path.join(OUTPUT_DIR, 'vectorized_model.fits'), output_test, overwrite=True)